@@ -0,0 +1,408 @@
+# (c) Ilya V. Schurov, 2016
+# Available under MIT license (see LICENSE file in the root folder)
+
+"""
+Frame-level rendering of matplotlib animations.
+
+Frames of an animation are saved to a frames cache one by one. Every
+frame is keyed by hashsum of everything that is drawn on it (see
+FrameHashRenderer), which is much cheaper to compute than to rasterize
+the frame, so only frames that are changed are rendered again.
+Rendered frames are then stitched into mp4 (with ffmpeg) or into
+javascript player.
+
+Several processes can render frames of the same animation: each of them
+draws all the frames (which is cheap) but saves only every n-th frame.
+
+The module relies on private matplotlib API, see frames_supported.
+"""
+
+from typing import Dict, List, Optional, Any
+import base64
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+import matplotlib
+import matplotlib.colors as mcolors
+from matplotlib import cbook
+import matplotlib.animation as manimation
+from matplotlib.backend_bases import RendererBase
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.transforms import BboxBase, Transform, TransformedPath
+
+from qqmbr.figmanifest import touch
+
+try:
+    from matplotlib import _animation_data
+except ImportError:
+    _animation_data = None
+
+# (first, last) major.minor versions of matplotlib that the private API
+# used here is checked with
+supported_matplotlib = ((3, 4), (3, 11))
+
+
+def frames_supported() -> bool:
+    """
+    Checks that animations can be rendered frame by frame with this
+    matplotlib. Otherwise they should be rendered with Animation.save
+    or Animation.to_jshtml.
+
+    :return:
+    """
+    version = tuple(
+        int(part) for part in re.findall(r"\d+", matplotlib.__version__)[:2]
+    )
+    first, last = supported_matplotlib
+    if not first <= version <= last:
+        return False
+    return (
+        _animation_data is not None
+        and hasattr(cbook, "_setattr_cm")
+        and hasattr(manimation, "_embedded_frames")
+        and hasattr(manimation, "_included_frames")
+        and all(
+            hasattr(manimation.Animation, name)
+            for name in ("_init_draw", "_pre_draw", "_draw_frame")
+        )
+    )
+
+
+class UnhashableFrame(Exception):
+    pass
+
+
+# subdirectory of frames_dir for frames that can't be cached
+transient_dir = "transient"
+
+
+def feed_hash(h, obj: Any) -> None:
+    """
+    Updates hash object h with obj that is passed to renderer
+
+    :raises UnhashableFrame: obj can't be hashed reliably
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        h.update(repr(obj).encode("utf-8"))
+    elif isinstance(obj, np.ndarray):
+        h.update(repr((obj.dtype.str, obj.shape)).encode("utf-8"))
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        h.update(repr(obj.item()).encode("utf-8"))
+    elif isinstance(obj, Path):
+        feed_hash(h, obj.vertices)
+        feed_hash(h, obj.codes)
+    elif isinstance(obj, TransformedPath):
+        feed_hash(h, obj.get_fully_transformed_path())
+    elif isinstance(obj, BboxBase):
+        feed_hash(h, obj.get_points())
+    elif isinstance(obj, Transform):
+        if not obj.is_affine:
+            raise UnhashableFrame(repr(obj))
+        feed_hash(h, obj.get_matrix())
+    elif isinstance(obj, FontProperties):
+        h.update(obj.get_fontconfig_pattern().encode("utf-8"))
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"(")
+        for item in obj:
+            feed_hash(h, item)
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for key in sorted(obj):
+            feed_hash(h, key)
+            feed_hash(h, obj[key])
+        h.update(b"}")
+    else:
+        raise UnhashableFrame(repr(obj))
+
+
+class FrameHashRenderer(RendererAgg):
+    """
+    Renderer that doesn't draw anything, but computes hashsum of all
+    drawing calls. Text metrics are taken from Agg, so the layout is
+    the same as in the real output.
+    """
+
+    def __init__(self, width, height, dpi):
+        super().__init__(width, height, dpi)
+        self.hash = hashlib.md5()
+
+    def feed(self, kind: str, gc, *args) -> None:
+        self.hash.update(kind.encode("utf-8"))
+        feed_hash(
+            self.hash,
+            {k: v for k, v in vars(gc).items() if k != "_renderer"},
+        )
+        feed_hash(self.hash, args)
+
+    def draw_path(self, gc, path, transform, rgbFace=None):
+        self.feed("path", gc, path, transform, rgbFace)
+
+    def draw_markers(
+        self, gc, marker_path, marker_trans, path, trans, rgbFace=None
+    ):
+        self.feed(
+            "markers", gc, marker_path, marker_trans, path, trans, rgbFace
+        )
+
+    def draw_text(self, gc, x, y, s, prop, angle, ismath=False, mtext=None):
+        self.feed("text", gc, x, y, s, prop, angle, ismath)
+
+    def draw_image(self, gc, x, y, im, transform=None):
+        self.feed("image", gc, x, y, im, transform)
+
+    # these are decomposed into calls of the methods above
+    draw_path_collection = RendererBase.draw_path_collection
+    draw_quad_mesh = RendererBase.draw_quad_mesh
+    draw_gouraud_triangles = RendererBase.draw_gouraud_triangles
+
+
+def frame_key(
+    fig, fmt: str, savefig_kwargs: Dict[str, Any]
+) -> Optional[str]:
+    """
+    Hashsum of the current state of figure as it will be saved
+
+    :param fig:
+    :param fmt: format of the frame
+    :param savefig_kwargs:
+    :return: None if the figure contains something that can't be hashed
+    """
+    width, height = fig.canvas.get_width_height()
+    renderer = FrameHashRenderer(width, height, fig.dpi)
+    try:
+        feed_hash(
+            renderer.hash,
+            (matplotlib.__version__, fmt, fig.dpi, savefig_kwargs),
+        )
+        fig.draw(renderer)
+    except UnhashableFrame:
+        return None
+    return renderer.hash.hexdigest()
+
+
+def frame_savefig_kwargs(fig) -> Dict[str, Any]:
+    """
+    Options of savefig for frames, the same as Animation.save uses
+    for writers that don't support transparency
+
+    :param fig:
+    :return:
+    """
+    facecolor = matplotlib.rcParams["savefig.facecolor"]
+    if facecolor == "auto":
+        facecolor = fig.get_facecolor()
+    r, g, b, a = mcolors.to_rgba(facecolor)
+    return {
+        "facecolor": tuple(a * np.array([r, g, b]) + 1 - a),
+        "transparent": False,
+    }
+
+
+def render_frames(
+    animation: manimation.Animation,
+    frames_dir: str,
+    fmt: str,
+    worker: int = 0,
+    workers: int = 1,
+    even_size: bool = False,
+) -> List[Optional[str]]:
+    """
+    Renders frames of animation to frames_dir.
+
+    Every worker draws all the frames, but saves only frames number
+    worker, worker + workers, worker + 2 * workers, etc.
+
+    :param animation:
+    :param frames_dir: frames cache, frames are saved to
+                       frames_dir/<xx>/<hashsum>.<fmt>
+    :param fmt: format of frames
+    :param worker: number of this worker
+    :param workers: total number of workers
+    :param even_size: adjust figure size to even number of pixels
+                      (needed by h264)
+    :return: list of paths of frames, None for frames of other workers
+    """
+    fig = animation._fig
+    if even_size:
+        width, height = fig.get_size_inches()
+        fig.set_size_inches(
+            *manimation.adjusted_figsize(width, height, fig.dpi, 2)
+        )
+    savefig_kwargs = frame_savefig_kwargs(fig)
+    paths: List[Optional[str]] = []
+    # canvas._is_saving disables the callback that restarts
+    # the animation on the first draw, as in Animation.save
+    with matplotlib.rc_context(
+        {"savefig.bbox": None}
+    ), cbook._setattr_cm(fig.canvas, _is_saving=True, manager=None):
+        animation._init_draw()
+        for i, framedata in enumerate(animation.new_saved_frame_seq()):
+            # the same as _draw_next_frame, without redrawing canvas
+            animation._pre_draw(framedata, False)
+            animation._draw_frame(framedata)
+            if i % workers != worker:
+                paths.append(None)
+                continue
+            key = frame_key(fig, fmt, savefig_kwargs)
+            if key is None:
+                # can't be cached, see remove_transient_frames
+                path = os.path.join(
+                    frames_dir,
+                    transient_dir,
+                    "{}-{}-{}.{}".format(
+                        os.getpid(), threading.get_ident(), i, fmt
+                    ),
+                )
+            else:
+                path = os.path.join(frames_dir, key[:2], key + "." + fmt)
+            if key is not None and os.path.isfile(path):
+                touch(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = "{}.{}.tmp.{}".format(path, os.getpid(), fmt)
+                fig.savefig(tmp, format=fmt, dpi=fig.dpi, **savefig_kwargs)
+                os.replace(tmp, path)
+            paths.append(path)
+    return paths
+
+
+def remove_transient_frames(frames: List[str]) -> None:
+    """
+    Removes frames that are not cached, should be called when
+    the frames are stitched
+
+    :param frames: paths returned by render_frames
+    """
+    for frame in frames:
+        if os.path.basename(os.path.dirname(frame)) == transient_dir:
+            os.remove(frame)
+
+
+def animation_fps(animation: manimation.Animation) -> float:
+    return 1000 / animation._interval
+
+
+def stitch_mp4(
+    frames: List[str], fps: float, filename: str, bitrate: int = 2000
+) -> None:
+    """
+    Encodes png frames to video with ffmpeg, with the same options
+    that Animation.save uses by default
+
+    :param frames: paths of frames in order
+    :param fps:
+    :param filename: path of the video
+    :param bitrate: in kbps
+    """
+    codec = matplotlib.rcParams["animation.codec"]
+    extra_args = list(matplotlib.rcParams["animation.ffmpeg_args"])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, frame in enumerate(frames):
+            link = os.path.join(tmpdir, "frame{:07d}.png".format(i))
+            try:
+                os.symlink(os.path.abspath(frame), link)
+            except OSError:
+                shutil.copyfile(frame, link)
+        command = [
+            matplotlib.rcParams["animation.ffmpeg_path"],
+            "-framerate", str(fps),
+            "-i", os.path.join(tmpdir, "frame%07d.png"),
+            "-vcodec", codec,
+        ]
+        if codec == "h264" and "-pix_fmt" not in extra_args:
+            command += ["-pix_fmt", "yuv420p"]
+        command += ["-b", "{}k".format(bitrate)] + extra_args
+        command += ["-y", filename]
+        subprocess.run(
+            command,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+
+def player_html(
+    fill_frames: str, frame_count: int, fps: float, default_mode="once"
+) -> str:
+    """
+    Javascript player, the same as HTMLWriter produces
+
+    :param fill_frames: javascript that fills frames array
+    :param frame_count:
+    :param fps:
+    :param default_mode: "once", "loop" or "reflect"
+    :return:
+    """
+    mode_dict = dict(once_checked="", loop_checked="", reflect_checked="")
+    mode_dict[default_mode + "_checked"] = "checked"
+    return (
+        _animation_data.JS_INCLUDE
+        + _animation_data.STYLE_INCLUDE
+        + _animation_data.DISPLAY_TEMPLATE.format(
+            id=hashlib.md5(fill_frames.encode("utf-8")).hexdigest(),
+            Nframes=frame_count,
+            fill_frames=fill_frames,
+            interval=int(1000 // fps),
+            **mode_dict
+        )
+    )
+
+
+def stitch_jshtml(frames: List[str], fps: float, fmt: str) -> str:
+    """
+    Javascript player with frames embedded as base64
+
+    :param frames: paths of frames in order
+    :param fps:
+    :param fmt: format of frames
+    :return: HTML of the player
+    """
+    encoded = []
+    for frame in frames:
+        with open(frame, "rb") as f:
+            encoded.append(base64.encodebytes(f.read()).decode("ascii"))
+    return player_html(
+        manimation._embedded_frames(encoded, fmt), len(frames), fps
+    )
+
+
+def stitch_html(
+    frames: List[str], fps: float, fmt: str, filename: str
+) -> None:
+    """
+    Javascript player that loads frames from files, like HTMLWriter
+    with embed_frames=False. Frames are copied to <name>_frames
+    directory next to filename.
+
+    :param frames: paths of frames in order
+    :param fps:
+    :param fmt: format of frames
+    :param filename: path of HTML file
+    """
+    base, _ = os.path.splitext(filename)
+    frames_dir = base + "_frames"
+    os.makedirs(frames_dir, exist_ok=True)
+    for i, frame in enumerate(frames):
+        shutil.copyfile(
+            frame,
+            os.path.join(frames_dir, "frame{:07d}.{}".format(i, fmt)),
+        )
+    html = player_html(
+        manimation._included_frames(
+            len(frames), fmt, os.path.basename(frames_dir)
+        ),
+        len(frames),
+        fps,
+    )
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(html)
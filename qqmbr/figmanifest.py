@@ -0,0 +1,334 @@
+# (c) Ilya V. Schurov, 2016
+# Available under MIT license (see LICENSE file in the root folder)
+
+"""
+Manifest of rendered python figures.
+
+Figures are stored in figures_dir/<xx>/<hashsum>/fig.<ext>. The manifest
+(figures_dir/manifest.json) keeps formats, size, render time and the
+last build that used every figure, so rendering does not need to stat
+files, and old figures can be garbage collected. Figures removed by hand
+are forgotten by gc.
+
+Other disk caches (rendered fragments, plotly and pythoncode output,
+animation frames etc.) are content-addressed files that are touched
+when they are used, so they are pruned by mtime, see prune_cache.
+"""
+
+from typing import Dict, List, Optional, Set, Tuple, Iterator, Iterable
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class FigureManifest(object):
+    filename = "manifest.json"
+
+    def __init__(self, figures_dir: str) -> None:
+        self.figures_dir = figures_dir
+        self.path = os.path.join(figures_dir, self.filename)
+        # relpath -> {"formats", "size", "render_time",
+        #             "last_used", "last_used_time"}
+        self.figures: Dict[str, dict] = {}
+        self.build = 0
+        self.dirty = False
+        # relpaths of entries changed since the last take_changes
+        self.changed: Set[str] = set()
+        # False in forked workers: their changes are merged
+        # by the parent process, see take_changes
+        self.autosave = True
+        self._lock = threading.RLock()
+        self.load()
+        # every formatter that uses the manifest is a new build
+        self.build += 1
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.figures = data.get("figures", {})
+        self.build = data.get("build", 0)
+
+    def save(self) -> None:
+        with self._lock:
+            if not self.dirty or not self.autosave:
+                return
+            os.makedirs(self.figures_dir, exist_ok=True)
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"build": self.build, "figures": self.figures},
+                    f,
+                    indent=1,
+                    sort_keys=True,
+                )
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+    def has(self, relpath: str, exts: Iterable[str]) -> bool:
+        """
+        Checks that figure is rendered in all formats exts and marks
+        it as used. Files are not checked, see gc.
+
+        :param relpath: path of figure directory relative to figures_dir
+        :param exts:
+        :return:
+        """
+        exts = set(exts)
+        with self._lock:
+            entry = self.figures.get(relpath)
+            if entry is None or not exts <= set(entry["formats"]):
+                return False
+            self.touch(relpath)
+            return True
+
+    def touch(self, relpath: str) -> None:
+        with self._lock:
+            entry = self.figures[relpath]
+            if entry["last_used"] != self.build:
+                entry["last_used"] = self.build
+                entry["last_used_time"] = time.time()
+                self.dirty = True
+                self.changed.add(relpath)
+
+    def take_changes(self) -> Dict[str, Optional[dict]]:
+        """
+        Returns entries changed since the last call (None for removed
+        ones), so a forked worker can pass them to the parent process
+        instead of saving the manifest, see merge
+
+        :return: relpath -> entry
+        """
+        with self._lock:
+            changes = {
+                relpath: self.figures.get(relpath)
+                for relpath in self.changed
+            }
+            self.changed.clear()
+        return changes
+
+    def merge(self, changes: Dict[str, Optional[dict]]) -> None:
+        """
+        Applies changes made by another process, see take_changes
+
+        :param changes:
+        """
+        with self._lock:
+            for relpath, entry in changes.items():
+                if entry is None:
+                    self.figures.pop(relpath, None)
+                else:
+                    self.figures[relpath] = entry
+                self.changed.add(relpath)
+            if changes:
+                self.dirty = True
+
+    def add(
+        self,
+        relpath: str,
+        exts: Iterable[str],
+        render_time: Optional[float] = None,
+    ) -> None:
+        """
+        Adds rendered figure to the manifest
+
+        :param relpath: path of figure directory relative to figures_dir
+        :param exts: formats that are rendered
+        :param render_time: time of rendering, seconds
+        :return:
+        """
+        with self._lock:
+            entry = self.figures.setdefault(
+                relpath, {"formats": [], "render_time": None}
+            )
+            entry["formats"] = sorted(set(entry["formats"]) | set(exts))
+            entry["size"] = self.dir_size(
+                os.path.join(self.figures_dir, relpath)
+            )
+            if render_time is not None:
+                entry["render_time"] = render_time
+            entry["last_used"] = self.build
+            entry["last_used_time"] = time.time()
+            self.dirty = True
+            self.changed.add(relpath)
+
+    @staticmethod
+    def dir_size(path: str) -> int:
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return size
+
+    def scan(self) -> Iterator[str]:
+        """
+        Yields relpaths of all figure directories in figures_dir
+
+        :return:
+        """
+        try:
+            prefixes = sorted(os.listdir(self.figures_dir))
+        except FileNotFoundError:
+            return
+        for prefix in prefixes:
+            prefix_dir = os.path.join(self.figures_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in sorted(os.listdir(prefix_dir)):
+                if name.startswith(prefix) and os.path.isdir(
+                    os.path.join(prefix_dir, name)
+                ):
+                    yield os.path.join(prefix, name)
+
+    def remove(self, relpath: str) -> int:
+        with self._lock:
+            entry = self.figures.pop(relpath, None)
+            self.dirty = True
+            self.changed.add(relpath)
+        path = os.path.join(self.figures_dir, relpath)
+        size = entry["size"] if entry else self.dir_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        return size
+
+    def gc(
+        self,
+        referenced: Set[str],
+        max_size: Optional[int] = None,
+        figname: str = "fig",
+    ) -> Tuple[int, int]:
+        """
+        Forgets figures that are removed by hand, removes figures that
+        are not referenced, then least recently used ones until total
+        size is at most max_size
+
+        :param referenced: relpaths of figures used by the book
+        :param max_size: size limit in bytes, None for no limit
+        :param figname: name of figure files, without extension
+        :return: (number of removed figures, freed bytes)
+        """
+        with self._lock:
+            on_disk = set(self.scan())
+            for relpath, entry in list(self.figures.items()):
+                path = os.path.join(self.figures_dir, relpath)
+                if relpath not in on_disk or not all(
+                    os.path.isfile(os.path.join(path, figname + "." + ext))
+                    for ext in entry["formats"]
+                ):
+                    # removed by hand
+                    del self.figures[relpath]
+                    self.dirty = True
+                    self.changed.add(relpath)
+
+            removed, freed = 0, 0
+            for relpath in sorted(on_disk - referenced):
+                freed += self.remove(relpath)
+                removed += 1
+
+            for relpath in on_disk & referenced:
+                if relpath not in self.figures:
+                    entry = self.figures[relpath] = {
+                        "formats": [],
+                        "render_time": None,
+                        "last_used": 0,
+                        "last_used_time": 0,
+                    }
+                    entry["size"] = self.dir_size(
+                        os.path.join(self.figures_dir, relpath)
+                    )
+                    self.dirty = True
+
+            if max_size is not None:
+                total = sum(entry["size"] for entry in self.figures.values())
+                by_age = sorted(
+                    self.figures,
+                    key=lambda relpath: (
+                        self.figures[relpath]["last_used"],
+                        self.figures[relpath]["last_used_time"],
+                    ),
+                )
+                for relpath in by_age:
+                    if total <= max_size:
+                        break
+                    size = self.remove(relpath)
+                    total -= size
+                    freed += size
+                    removed += 1
+
+            self.save()
+        return removed, freed
+
+
+def touch(path: str) -> None:
+    """
+    Marks cached file as used, see prune_cache
+
+    :param path:
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def prune_cache(
+    cache_dir: str,
+    max_age: Optional[float] = None,
+    max_size: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Removes files of cache_dir that are not used (written or touched)
+    for max_age seconds, then least recently used ones until total
+    size is at most max_size
+
+    :param cache_dir:
+    :param max_age: age limit in seconds, None for no limit
+    :param max_size: size limit in bytes, None for no limit
+    :return: (number of removed files, freed bytes)
+    """
+    files: List[Tuple[float, int, str]] = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    now = time.time()
+    total = sum(size for mtime, size, path in files)
+    removed, freed = 0, 0
+    for mtime, size, path in files:
+        too_old = max_age is not None and now - mtime > max_age
+        too_big = max_size is not None and total > max_size
+        if not too_old and not too_big:
+            # the rest are newer, and total only decreases
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+        removed += 1
+
+    for dirpath, dirnames, filenames in os.walk(cache_dir, topdown=False):
+        if dirpath != cache_dir:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # not empty
+                pass
+    return removed, freed
@@ -0,0 +1,414 @@
+# (c) Ilya V. Schurov, 2016
+# Available under MIT license (see LICENSE file in the root folder)
+
+"""
+Server-side MathJax: a pool of long-lived mathjax-node-page workers
+(see mjworker.js) that typeset HTML pages.
+
+Every worker is a node process that reads requests from stdin and writes
+replies to stdout, one JSON object per line, so MathJax startup cost
+is paid once per worker and not once per page.
+
+FormulaCache keeps typeset formulas on disk, so only new formulas
+are sent to MathJax.
+"""
+
+from subprocess import Popen, PIPE, TimeoutExpired
+from typing import List, Optional, Tuple, Dict
+from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+import threading
+import queue
+import json
+import os
+import re
+import hashlib
+import itertools
+
+from qqmbr.figmanifest import touch
+
+
+class MathJaxError(Exception):
+    pass
+
+
+class MathJaxWorker(object):
+    def __init__(self, command: List[str]) -> None:
+        self.process = Popen(
+            command,
+            stdin=PIPE,
+            stdout=PIPE,
+            encoding="utf-8",
+            bufsize=1,
+        )
+        self._ids = itertools.count()
+
+    def typeset(self, pages: List[str]) -> List[str]:
+        """
+        Typesets a batch of HTML pages
+
+        :param pages: list of HTML strings
+        :return: list of typeset HTML strings, in the same order
+        """
+        request_id = next(self._ids)
+        self.process.stdin.write(
+            json.dumps({"id": request_id, "pages": pages}) + "\n"
+        )
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            try:
+                # stdout is closed just before the process exits
+                code = self.process.wait(timeout=1)
+            except TimeoutExpired:
+                code = None
+            raise MathJaxError(
+                "MathJax worker exited with code {}".format(code)
+            )
+        reply = json.loads(line)
+        if reply.get("id") != request_id:
+            raise MathJaxError("MathJax worker is out of sync")
+        if "error" in reply:
+            raise MathJaxError(reply["error"])
+        return reply["pages"]
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+
+
+class MathJaxPool(object):
+    """
+    Pool of MathJax workers. Workers are started lazily, up to size,
+    when there are more concurrent requests than idle workers.
+
+    Can be used from several threads.
+    """
+
+    def __init__(self, command: List[str], size: Optional[int] = None):
+        self.command = command
+        self.size = size or os.cpu_count() or 1
+        self._workers: List[MathJaxWorker] = []
+        self._idle: "queue.LifoQueue[MathJaxWorker]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> MathJaxWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._workers) < self.size:
+                worker = MathJaxWorker(self.command)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def _discard(self, worker: MathJaxWorker) -> None:
+        with self._lock:
+            self._workers.remove(worker)
+        worker.close()
+
+    def typeset(self, pages: List[str]) -> List[str]:
+        """
+        Typesets a batch of HTML pages on one of the workers
+
+        :param pages: list of HTML strings
+        :return: list of typeset HTML strings, in the same order
+        """
+        worker = self._acquire()
+        try:
+            result = worker.typeset(pages)
+        except Exception:
+            # worker state is unknown, don't reuse it
+            self._discard(worker)
+            raise
+        self._idle.put(worker)
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+def fix_mjpage_bug(inp, out):
+    replacements = {}
+    bad_pattern = re.compile(
+        "[а-яА-Яa-zA-Z ]{0,10}\uFFFD\uFFFD[а-яА-Яa-zA-Z ]{0,10}"
+    )
+    for m in re.finditer(bad_pattern, out):
+        # print(f"Bad input found: {m.group(0)}")
+        pattern = m.group(0).replace("\uFFFD\uFFFD", ".")
+        replacement = re.search(pattern, inp)
+        if replacement:
+            # (f"Replacement found: {replacement}")
+            replacements[m.group(0)] = replacement.group(0)
+        else:
+            pass
+            # print(f"{pattern} not found.")
+    return re.sub(
+        bad_pattern,
+        lambda m: replacements.get(m.group(0), m.group(0)),
+        out,
+    )
+
+
+def typeset_page(pool: MathJaxPool, page: str) -> Tuple[str, str]:
+    """
+    Typesets HTML page as a whole
+
+    :param pool:
+    :param page: HTML to typeset
+    :return: (style, body)
+    """
+    out = fix_mjpage_bug(page, pool.typeset([page])[0])
+    soup = BeautifulSoup(out, "html.parser")
+    style = str(soup.style)
+    body = "".join(str(s) for s in soup.body.children)
+    return style, body
+
+
+# Formulas as MathJax finds them in HTML: \[...\], $$...$$, \(...\)
+# and $...$, outside of tags that MathJax skips. Formulas that contain
+# HTML tags are left as is.
+math_re = re.compile(
+    r"(?P<skip><(?P<tag>pre|code|script|style|textarea)\b.*?</(?P=tag)\s*>)"
+    r"|(?P<display>\$\$[^<]+?\$\$|\\\[[^<]+?\\\])"
+    r"|(?P<inline>\\\([^<]+?\\\)|(?<!\\)\$(?:[^$<\\]|\\.)+?\$)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# \$ outside of formulas is typeset as $ (processEscapes of tex2jax),
+# tags are matched to leave their attributes as is
+escape_re = re.compile(r"<[^>]*>|\\\$")
+
+# Formulas that define macros: the definitions apply to the formulas
+# after them on the same page, so such formulas can't be typeset
+# (and cached) one by one
+macro_definition_re = re.compile(
+    r"\\(?:(?:re|provide)?newcommand|(?:re)?newenvironment|def|gdef"
+    r"|edef|let|DeclareMathOperator)(?![a-zA-Z])"
+)
+
+
+class FormulaCache(object):
+    """
+    Disk-backed cache of typeset formulas.
+
+    The key of every formula is based on its TeX source (with delimiters),
+    display mode and hashsum of the preamble. Formulas that are not in
+    the cache are typeset by the pool in one batch. Pages that define
+    macros outside of the preamble are typeset as a whole and are not
+    cached.
+    """
+
+    def __init__(self, cache_dir: str, pool: MathJaxPool) -> None:
+        self.cache_dir = cache_dir
+        self.pool = pool
+
+    @staticmethod
+    def formula_key(source: str, display: bool, preamble_hash: str) -> str:
+        return hashlib.sha256(
+            json.dumps([source, display, preamble_hash]).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".html")
+
+    def _read(self, path: str) -> Optional[str]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        # see figmanifest.prune_cache
+        touch(path)
+        return content
+
+    def _write(self, path: str, content: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.{}.tmp".format(
+            path, os.getpid(), threading.get_ident()
+        )
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def typeset_formulas(
+        self, formulas: Dict[str, str], preamble: str
+    ) -> Tuple[str, Dict[str, str]]:
+        """
+        Typesets formulas in one MathJax page
+
+        :param formulas: key -> formula source
+        :param preamble: HTML with preamble formula (macros definitions)
+        :return: (style, key -> typeset formula)
+        """
+        page = preamble + "".join(
+            "<div id='qq-formula-{}'>{}</div>".format(key, source)
+            for key, source in formulas.items()
+        )
+        out = fix_mjpage_bug(page, self.pool.typeset([page])[0])
+        soup = BeautifulSoup(out, "html.parser")
+        rendered = {}
+        for key in formulas:
+            div = soup.find(id="qq-formula-" + key)
+            if div is not None:
+                rendered[key] = "".join(str(c) for c in div.children)
+        return str(soup.style), rendered
+
+    def typeset(self, html: str, preamble: str = "") -> Tuple[str, str]:
+        """
+        Replaces every formula in html with its typeset version
+
+        :param html: HTML to process
+        :param preamble: HTML with preamble formula (macros definitions),
+                         it is prepended to the result as is
+        :return: (style, body)
+        """
+        preamble_hash = hashlib.sha256(preamble.encode("utf-8")).hexdigest()
+        chunks: List[str] = []
+        keys: List[Tuple[int, str]] = []
+        sources: Dict[str, str] = {}
+        pos = 0
+        for m in math_re.finditer(html):
+            chunks.append(unescape_dollars(html[pos : m.start()]))
+            pos = m.end()
+            if m.group("skip"):
+                chunks.append(m.group(0))
+                continue
+            if macro_definition_re.search(m.group(0)):
+                return typeset_page(self.pool, preamble + html)
+            key = self.formula_key(
+                m.group(0), bool(m.group("display")), preamble_hash
+            )
+            keys.append((len(chunks), key))
+            chunks.append(m.group(0))
+            sources[key] = m.group(0)
+        chunks.append(unescape_dollars(html[pos:]))
+
+        rendered = {}
+        missing = {}
+        for key, source in sources.items():
+            cached = self._read(self._path(key))
+            if cached is None:
+                missing[key] = source
+            else:
+                rendered[key] = cached
+
+        # style depends on the preamble, e.g. on fonts it uses
+        style_path = os.path.join(
+            self.cache_dir, "style", preamble_hash + ".html"
+        )
+        style = None
+        if not missing:
+            style = self._read(style_path)
+            if style is None and sources:
+                # style is removed (e.g. pruned): typeset one
+                # of the formulas again to restore it
+                key = next(iter(sources))
+                missing[key] = sources[key]
+        if missing:
+            style, new = self.typeset_formulas(missing, preamble)
+            for key, value in new.items():
+                self._write(self._path(key), value)
+            self._write(style_path, style)
+            rendered.update(new)
+
+        for i, key in keys:
+            if key in rendered:
+                chunks[i] = rendered[key]
+
+        return style or "", preamble + "".join(chunks)
+
+
+def unescape_dollars(html: str) -> str:
+    """
+    Replaces \\$ with $ in text of HTML, as MathJax does outside
+    of formulas
+
+    :param html:
+    :return:
+    """
+    return escape_re.sub(
+        lambda m: "$" if m.group(0) == "\\$" else m.group(0), html
+    )
+
+
+class EqIndexParser(HTMLParser):
+    """
+    Finds equations numbered by MathJax (elements with id mjx-eqn-N)
+    and collects HTML of the innermost mjx-chtml element around each.
+    """
+
+    void_elements = {
+        "area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr",
+    }
+
+    def __init__(self, html: str) -> None:
+        super().__init__(convert_charrefs=False)
+        self.html = html
+        # getpos() counts lines by \n only, unlike str.splitlines
+        self.line_offsets = [0]
+        for line in html.split("\n"):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+        # stack of [name, start offset, is mjx-chtml, eq numbers inside]
+        self.stack: List[list] = []
+        self.index: Dict[str, str] = {}
+
+    def position(self) -> int:
+        line, col = self.getpos()
+        return self.line_offsets[line - 1] + col
+
+    def start(self, tag, attrs, closed):
+        attrs = dict(attrs)
+        eq_id = attrs.get("id") or ""
+        if eq_id.startswith("mjx-eqn-"):
+            for element in reversed(self.stack):
+                if element[2]:
+                    element[3].append(eq_id[len("mjx-eqn-") :])
+                    break
+        if closed or tag in self.void_elements:
+            return
+        is_chtml = "mjx-chtml" in (attrs.get("class") or "").split()
+        self.stack.append([tag, self.position(), is_chtml, []])
+
+    def handle_starttag(self, tag, attrs):
+        self.start(tag, attrs, closed=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self.start(tag, attrs, closed=True)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                break
+        else:
+            return
+        _, start, is_chtml, numbers = self.stack[i]
+        del self.stack[i:]
+        if is_chtml and numbers:
+            end = self.html.index(">", self.position()) + 1
+            fragment = self.html[start:end]
+            for number in numbers:
+                self.index.setdefault(number, fragment)
+
+
+def build_eq_index(html: str) -> Dict[str, str]:
+    """
+    Builds index of equations in HTML typeset by MathJax
+
+    :param html: typeset HTML
+    :return: dict equation number -> HTML of the equation
+    """
+    parser = EqIndexParser(html)
+    parser.feed(html)
+    parser.close()
+    return parser.index
@@ -0,0 +1,86 @@
+// (c) Ilya V. Schurov, 2016
+// Available under MIT license (see LICENSE file in the root folder)
+
+// Long-lived mathjax-node-page worker used by qqmbr/mjnode.py
+//
+// Usage: node mjworker.js <path to mathjax-node-page> <fontURL>
+//
+// Reads requests from stdin, one JSON object per line:
+//     {"id": 1, "pages": ["<html>...", ...]}
+// and writes one JSON object per line to stdout for every request:
+//     {"id": 1, "pages": ["<typeset html>...", ...]}
+// or {"id": 1, "error": "..."} if typesetting failed.
+// Requests are processed one by one in the order they came.
+
+const readline = require("readline");
+const mjpage = require(process.argv[2]).mjpage;
+const fontURL = process.argv[3];
+
+// stdout is reserved for replies
+console.log = console.error;
+console.info = console.error;
+
+function typeset(page) {
+    return new Promise(function (resolve) {
+        mjpage(
+            page,
+            {
+                format: ["TeX"],
+                output: "html",
+                singleDollars: true,
+                fontURL: fontURL,
+            },
+            {},
+            resolve
+        );
+    });
+}
+
+const queue = [];
+let busy = false;
+let closed = false;
+
+async function processRequest(request) {
+    const reply = { id: request.id };
+    try {
+        reply.pages = [];
+        for (const page of request.pages) {
+            reply.pages.push(await typeset(page));
+        }
+    } catch (e) {
+        delete reply.pages;
+        reply.error = String(e);
+    }
+    process.stdout.write(JSON.stringify(reply) + "\n");
+}
+
+async function pump() {
+    if (busy) {
+        return;
+    }
+    busy = true;
+    while (queue.length) {
+        await processRequest(queue.shift());
+    }
+    busy = false;
+    if (closed) {
+        process.exit(0);
+    }
+}
+
+readline
+    .createInterface({ input: process.stdin })
+    .on("line", function (line) {
+        if (!line.trim()) {
+            return;
+        }
+        queue.push(JSON.parse(line));
+        pump();
+    })
+    .on("close", function () {
+        // exit as soon as pending requests are finished
+        closed = true;
+        if (!busy) {
+            process.exit(0);
+        }
+    });
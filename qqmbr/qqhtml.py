@@ -8,8 +8,10 @@ import inspect
 import hashlib
 import os
 import urllib.parse
+import bisect
 from mako.template import Template
-from fuzzywuzzy import process
+from mako.lookup import TemplateLookup
+from fuzzywuzzy import fuzz, utils as fuzzy_utils
 from html import escape as html_escape
 from typing import Optional, List
 from typing import (
@@ -20,19 +22,57 @@ from typing import (
     Dict,
     Iterator,
     Any,
+    Callable,
+    FrozenSet,
+    Iterable,
+    Set,
 )
 from textwrap import indent, dedent
 import contextlib
+import copy
 import sys
+import pickle
+import types
+import importlib
+import time
+import tempfile
+import threading
+import uuid
+import logging
+import multiprocessing
 from io import StringIO
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 
 import matplotlib
 
 matplotlib.use("Agg")
 
 import matplotlib.pyplot as plt
+from matplotlib.animation import HTMLWriter
 from celluloid import Camera
 
+from qqmbr.figmanifest import FigureManifest, touch
+from qqmbr.sandbox import SandboxPool, SandboxSession
+from qqmbr.animframes import (
+    frames_supported,
+    render_frames,
+    remove_transient_frames,
+    animation_fps,
+    stitch_mp4,
+    stitch_jshtml,
+    stitch_html,
+)
+
+logger = logging.getLogger(__name__)
+
+# processes that render figures are started from scratch, as sandbox
+# workers are: the preview server is threaded and forking it
+# is not safe
+figure_mp_context = multiprocessing.get_context("spawn")
 
 def mk_safe_css_ident(s):
     # see http://stackoverflow.com/a/449000/3025981 for details
@@ -55,18 +95,52 @@ def make_sure_path_exists(path):
 
 # END FROM
 
-# FROM: http://stackoverflow.com/a/3906390/3025981
+class ThreadStdout(object):
+    """
+    Replacement of sys.stdout that writes to the stream set
+    by stdout_io in the current thread, so output of other threads
+    is not captured
+    """
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.local = threading.local()
+        # number of stdout_io blocks that use this object
+        self.users = 0
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, "stream", self.stream), name)
+
+
+_stdout_lock = threading.Lock()
+
+
+# BASED ON: http://stackoverflow.com/a/3906390/3025981
 @contextlib.contextmanager
 def stdout_io(stdout=None):
-    old = sys.stdout
     if stdout is None:
         stdout = StringIO()
-    sys.stdout = stdout
-    yield stdout
-    sys.stdout = old
+    with _stdout_lock:
+        if not isinstance(sys.stdout, ThreadStdout):
+            sys.stdout = ThreadStdout(sys.stdout)
+        proxy = sys.stdout
+        proxy.users += 1
+    old = getattr(proxy.local, "stream", None)
+    proxy.local.stream = stdout
+    try:
+        yield stdout
+    finally:
+        if old is None:
+            del proxy.local.stream
+        else:
+            proxy.local.stream = old
+        with _stdout_lock:
+            proxy.users -= 1
+            if not proxy.users and sys.stdout is proxy:
+                sys.stdout = proxy.stream
 
 
-# END FROM
+# END BASED ON
 
 
 T = TypeVar("T")
@@ -105,6 +179,52 @@ def split_by_predicate(
 # END BASED
 
 
+def subtree_digests(
+    tag: QqTag, memo: Optional[Dict[int, Tuple[QqTag, str]]] = None
+) -> str:
+    """
+    Returns MD5-hashsum of tag's subtree (name and children, recursively).
+
+    Digest of every node is based on digests of its children, so every
+    node is hashed once. Digests of all nodes of the subtree are put to
+    memo: id(node) -> (node, digest); node is kept there to make sure
+    that its id is not reused. Nodes already in memo are not rehashed,
+    so memo has to be cleared when the tree changes.
+
+    :param tag:
+    :param memo:
+    :return: hex digest
+    """
+    if memo is None:
+        memo = {}
+    if id(tag) in memo:
+        return memo[id(tag)][1]
+
+    # iterative post-order walk, deep trees are not a problem
+    stack = [(tag, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in memo:
+            continue
+        if not children_done:
+            stack.append((node, True))
+            stack.extend(
+                (child, False)
+                for child in node.children_tags()
+                if id(child) not in memo
+            )
+            continue
+        hasher = hashlib.md5()
+        hasher.update(repr(("tag", node.name)).encode("utf-8"))
+        for child in node:
+            if isinstance(child, QqTag):
+                hasher.update(b"child:" + memo[id(child)][1].encode("ascii"))
+            else:
+                hasher.update(repr(("str", child)).encode("utf-8"))
+        memo[id(node)] = (node, hasher.hexdigest())
+    return memo[id(tag)][1]
+
+
 class Counter(object):
     """
     Very simple class that support latex-style counters with subcounters.
@@ -201,6 +321,26 @@ class FormattedTOCItem(object):
 
 
 plotly = None
+pygments = None
+
+
+def import_pygments() -> None:
+    """
+    Imports pygments on first use: it is needed only if code is
+    highlighted when rendering, see QqHTMLFormatter.highlight_code
+    """
+    global pygments
+    if pygments is None:
+        for name in ("formatters", "lexers", "util"):
+            importlib.import_module("pygments." + name)
+        # set after all submodules are imported, other threads may
+        # use it at once
+        pygments = importlib.import_module("pygments")
+
+
+plotly_div_id_re = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
 
 
 class PlotlyPlotter(object):
@@ -279,6 +419,496 @@ def extract_splitted_items(tag: QqTag) -> Tuple[QqTag, QqTag]:
     return long_tag, splitted_tag
 
 
+# pyplot state, sys.stdout (see stdout_io) and globals of figures are
+# shared by the whole process, so user code is executed by one thread
+# at a time
+exec_lock = threading.RLock()
+
+
+def render_python_fig(
+    code: str,
+    gl: Dict[str, Any],
+    path: str,
+    figname: str,
+    exts: Tuple[str, ...],
+    tight_layout=True,
+    video=False,
+) -> None:
+    """
+    Executes figure code in globals gl and saves the result to
+    path/figname.ext for every ext in exts
+
+    :param code: python code that draws the figure
+    :param gl: globals to run the code in
+    :param path: directory to save the figure to
+    :param figname: name of the file without extension
+    :param exts: extensions (formats) to save
+    :param tight_layout: apply plt.tight_layout() before saving
+    :param video: code produces `animation` object that should be saved
+    """
+    make_sure_path_exists(path)
+    plt.close()
+    exec(code, gl)
+    if video:
+        animation = gl["animation"]
+        for ext in exts:
+            filename = os.path.join(path, figname + "." + ext)
+            if ext == "jshtml":
+                # javascript player with embedded frames
+                write_atomically(
+                    filename, animation.to_jshtml(default_mode="once")
+                )
+            elif ext == "html":
+                # javascript player, frames are saved
+                # to path/<figname>_frames, named after the file,
+                # so it is not renamed; the file itself is written
+                # after all frames
+                animation.save(
+                    filename,
+                    writer=HTMLWriter(
+                        fps=1000 / animation._interval,
+                        embed_frames=False,
+                        default_mode="once",
+                    ),
+                )
+            else:
+                save_atomically(
+                    filename,
+                    lambda tmp: animation.save(tmp, bitrate=2000),
+                )
+
+    else:
+        if tight_layout:
+            plt.tight_layout()
+        for ext in exts:
+            save_atomically(
+                os.path.join(path, figname + "." + ext), plt.savefig
+            )
+
+
+def portable_globals(gl: Dict[str, Any]) -> Tuple[Dict[str, str], Dict]:
+    """
+    Splits globals into modules (that are passed to worker processes
+    by name) and other picklable values. Unpicklable values are dropped.
+
+    :param gl: globals dict
+    :return: (name -> module name, name -> value)
+    """
+    modules: Dict[str, str] = {}
+    values: Dict[str, Any] = {}
+    for name, value in gl.items():
+        if name == "__builtins__":
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        values[name] = value
+    return modules, values
+
+
+def module_fingerprint(module: types.ModuleType) -> str:
+    """
+    Version of the module or, if it has no version,
+    hashsum of its source file
+
+    :param module:
+    :return:
+    """
+    version = getattr(module, "__version__", None)
+    if version is not None:
+        return str(version)
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return module.__name__
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def globals_fingerprint(gl: Dict[str, Any]) -> str:
+    """
+    Hashsum of globals dict: versions of modules, pickled values
+    and names of values that can't be pickled
+
+    :param gl:
+    :return:
+    """
+    modules, values = portable_globals(gl)
+    return hashlib.md5(
+        repr(
+            [
+                sorted(
+                    (name, module_fingerprint(sys.modules[module]))
+                    for name, module in modules.items()
+                ),
+                sorted(
+                    (name, hashlib.md5(pickle.dumps(value)).hexdigest())
+                    for name, value in values.items()
+                ),
+                sorted(
+                    name
+                    for name in gl
+                    if name not in modules and name not in values
+                    and name != "__builtins__"
+                ),
+            ]
+        ).encode("utf8")
+    ).hexdigest()
+
+
+def write_atomically(path: str, content, mode: str = "w") -> None:
+    """
+    Writes content to path so that concurrent readers never see
+    a partially written file
+
+    :param path:
+    :param content: str or bytes
+    :param mode: "w" or "wb"
+    """
+    make_sure_path_exists(os.path.dirname(path))
+    tmp = "{}.{}.{}.tmp".format(
+        path, os.getpid(), threading.get_ident()
+    )
+    encoding = None if "b" in mode else "utf-8"
+    with open(tmp, mode, encoding=encoding) as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def save_atomically(path: str, save: Callable[[str], Any]) -> None:
+    """
+    Calls save(tmp) and renames tmp to path, so that a process killed
+    while saving (e.g. on timeout) doesn't leave a partial file that
+    looks like a rendered one. tmp has the same extension as path,
+    as matplotlib chooses the format by it.
+
+    :param path:
+    :param save: function that writes file with given name
+    """
+    root, ext = os.path.splitext(path)
+    tmp = "{}.{}.{}.tmp{}".format(
+        root, os.getpid(), threading.get_ident(), ext
+    )
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def exec_figures(
+    codes: Iterable[str], gl: Dict[str, Any], executed: Set[str]
+) -> None:
+    """
+    Executes code of figures that are not in executed yet, so the
+    globals they define are there for the next figures. Figures are
+    not saved, their errors are reported where they are rendered.
+
+    :param codes: code of figures in document order
+    :param gl: globals to run the code in
+    :param executed: code of figures executed in gl, updated
+    """
+    for code in codes:
+        if code in executed:
+            continue
+        executed.add(code)
+        plt.close()
+        try:
+            exec(code, gl)
+        except Exception:
+            pass
+    plt.close()
+
+
+_figure_worker_globals: Dict[str, Any] = {}
+_figure_worker_executed: Set[str] = set()
+
+
+def _init_figure_worker(
+    modules: Dict[str, str], values: Dict[str, Any], rcparams: Dict
+) -> None:
+    plt.rcParams.update(rcparams)
+    _figure_worker_globals.update(
+        {name: importlib.import_module(module)
+         for name, module in modules.items()}
+    )
+    _figure_worker_globals.update(values)
+
+
+def _render_figure_task(
+    code: str, path: str, figname: str, exts: Tuple[str, ...], video=False
+) -> float:
+    start = time.perf_counter()
+    render_python_fig(
+        code, _figure_worker_globals, path, figname, exts, video=video
+    )
+    return time.perf_counter() - start
+
+
+def _session_figure_task(
+    code: str, path: str, figname: str, exts: Tuple[str, ...], video=False
+) -> float:
+    # when the session is restored after timeout or crash,
+    # figures of the history are already saved: their code is only
+    # executed for the globals it defines
+    if all(
+        os.path.isfile(os.path.join(path, figname + "." + ext))
+        for ext in exts
+    ):
+        plt.close()
+        exec(code, _figure_worker_globals)
+        return 0.
+    _figure_worker_executed.add(code)
+    return _render_figure_task(code, path, figname, exts, video)
+
+
+def _session_preceding_task(codes: List[str]) -> None:
+    exec_figures(codes, _figure_worker_globals, _figure_worker_executed)
+
+
+def _session_jshtml_task(code: str) -> str:
+    plt.close()
+    _figure_worker_executed.add(code)
+    exec(code, _figure_worker_globals)
+    return _figure_worker_globals["animation"].to_jshtml(default_mode="once")
+
+
+def _sandbox_plotly_task(
+    code: str, modules: Dict[str, str], values: Dict[str, Any]
+) -> str:
+    global plotly
+    if plotly is None:
+        import plotly
+    plotter = PlotlyPlotter()
+    gl = {
+        name: importlib.import_module(module)
+        for name, module in modules.items()
+    }
+    gl.update(values)
+    gl.update(plot=plotter.plot, go=plotly.graph_objs, plotly=plotly)
+    exec(code, gl, {})
+    return plotter.get_data()
+
+
+def format_exception(e: BaseException) -> str:
+    return "Exception: {}\n{}\n".format(e.__class__.__name__, e)
+
+
+def exec_captured(code: str, gl: Dict[str, Any]) -> str:
+    """
+    Executes code in globals gl
+
+    :param code:
+    :param gl:
+    :return: captured output, exception is reported in the output
+    """
+    with stdout_io() as s:
+        try:
+            exec(code, gl)
+        except Exception as e:
+            print(format_exception(e), end="")
+    return s.getvalue()
+
+
+_pythoncode_worker_globals: Dict[str, Any] = {}
+
+
+def _sandbox_exec_pythoncode(code: str) -> str:
+    return exec_captured(code, _pythoncode_worker_globals)
+
+
+def _sandbox_reset_pythoncode() -> None:
+    _pythoncode_worker_globals.clear()
+
+
+def _render_frames_task(
+    code: str,
+    frames_dir: str,
+    fmt: str,
+    worker: int,
+    workers: int,
+    even_size: bool,
+) -> Tuple[float, List[Optional[str]]]:
+    plt.close()
+    exec(code, _figure_worker_globals)
+    animation = _figure_worker_globals["animation"]
+    frames = render_frames(
+        animation, frames_dir, fmt, worker, workers, even_size
+    )
+    return animation_fps(animation), frames
+
+
+multieq_template_source = dedent(
+    r"""
+    \[
+    \begin{${name}}
+    <% items = tag("item") %>
+    % if items:
+        % for i, item in enumerate(items):
+            ${formatter.format(item, blanks_to_pars=False)}
+            % if item.exists("number"):
+                \tag{${item.number_.value}}
+            % endif
+            % if i != len(items) - 1:
+                \\\
+            
+            % endif
+            % endfor
+    % endif
+    \end{${name}}
+    \]
+    """
+)
+
+template_lookups: Dict[Tuple[str, Optional[str]], TemplateLookup] = {}
+
+
+def get_template_lookup(
+    directory: str, module_directory: Optional[str] = None
+) -> TemplateLookup:
+    """
+    Returns TemplateLookup for templates directory. Lookups are shared
+    in the process, so every template is compiled only once.
+
+    :param directory: templates directory
+    :param module_directory: directory to store compiled templates (optional)
+    :return:
+    """
+    key = (directory, module_directory)
+    lookup = template_lookups.get(key)
+    if lookup is None:
+        lookup = TemplateLookup(
+            directories=[directory],
+            module_directory=module_directory,
+            input_encoding="utf-8",
+        )
+        lookup.put_string("multieq", multieq_template_source)
+        template_lookups[key] = lookup
+    return lookup
+
+
+def fuzzy_form(s: str) -> str:
+    """
+    Returns string as it is compared by process.extractOne
+    with default processor and scorer
+
+    :param s:
+    :return:
+    """
+    return fuzzy_utils.full_process(
+        fuzzy_utils.full_process(s), force_ascii=True
+    )
+
+
+class FlabelIndex(object):
+    """
+    Index to find flabel that is the best fuzzy match for a string,
+    i.e. ``process.extractOne(s, flabels)[0]``.
+
+    Flabel which is equal to the string (up to fuzzywuzzy processing)
+    is found by dict lookup. Otherwise, flabels that share a trigram
+    with the string are scored first, and all flabels are scored only
+    if none of them is a good match. Flabels that cannot beat (or, if
+    they come earlier, tie with) the best score due to their length
+    are not scored at all.
+    """
+
+    # exact match for strings that are longer can lose to another flabel
+    # due to rounding of the score
+    max_exact_length = 90
+    min_shortlist_score = 80
+
+    def __init__(self, flabels: Iterable[str]) -> None:
+        self.flabels = list(flabels)
+        self.forms = [fuzzy_form(flabel) for flabel in self.flabels]
+        self.exact: Dict[str, str] = {}
+        self.trigram_to_positions: Dict[str, List[int]] = {}
+        for i, (flabel, form) in enumerate(zip(self.flabels, self.forms)):
+            self.exact.setdefault(form, flabel)
+            for trigram in self.trigrams(form):
+                self.trigram_to_positions.setdefault(trigram, []).append(i)
+        self.memo: Dict[str, Optional[str]] = {}
+
+    @staticmethod
+    def trigrams(form: str) -> Set[str]:
+        padded = " " + form + " "
+        return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def max_score(form1: str, form2: str) -> int:
+        """
+        Upper bound of fuzz.WRatio(form1, form2) based on lengths only
+
+        :return:
+        """
+        if not form1 or not form2:
+            return 0
+        short, long = sorted([len(form1), len(form2)])
+        base = fuzzy_utils.intr(200 * short / (short + long))
+        len_ratio = long / short
+        if len_ratio < 1.5:
+            return max(base, 95)
+        if len_ratio > 8:
+            return max(base, 60)
+        return max(base, 90)
+
+    def best_match(
+        self, form: str, positions: Iterable[int]
+    ) -> Tuple[Optional[int], int]:
+        """
+        Same as process.extractOne, but flabels are given by
+        (increasing) positions and form is already processed
+
+        :return: (position of the flabel, score)
+        """
+        best, best_score = None, -1
+        for i in positions:
+            # ties are resolved in favor of the first one
+            if self.max_score(form, self.forms[i]) <= best_score:
+                continue
+            score = fuzz.WRatio(form, self.forms[i], full_process=False)
+            if score > best_score:
+                best, best_score = i, score
+        return best, best_score
+
+    def find(self, s: str) -> Optional[str]:
+        if s not in self.memo:
+            self.memo[s] = self._find(s)
+        return self.memo[s]
+
+    def _find(self, s: str) -> Optional[str]:
+        form = fuzzy_form(s)
+        if form and len(form) < self.max_exact_length and form in self.exact:
+            return self.exact[form]
+
+        positions = set()
+        for trigram in self.trigrams(form):
+            positions.update(self.trigram_to_positions.get(trigram, ()))
+        best = None
+        if form and positions:
+            best, score = self.best_match(form, sorted(positions))
+            if score < self.min_shortlist_score:
+                best = None
+        if best is None:
+            candidates: Iterable[int] = range(len(self.flabels))
+        else:
+            # flabels out of the shortlist that can beat the best one
+            # or tie with it and come before it
+            candidates = [
+                i
+                for i, other in enumerate(self.forms)
+                if i == best
+                or i not in positions
+                and self.max_score(form, other) >= score + (i > best)
+            ]
+        best = self.best_match(form, candidates)[0]
+        return None if best is None else self.flabels[best]
+
+
 class QqHTMLFormatter(object):
     def __init__(
         self,
@@ -290,6 +920,8 @@ class QqHTMLFormatter(object):
         self.templates_dir = os.path.join(
             os.path.dirname(os.path.realpath(__file__)), "templates"
         )
+        # where to keep compiled templates, None means in memory only
+        self.templates_module_dir: Optional[str] = None
 
         self.with_chapters = with_chapters
         self.eq_preview_by_labels = eq_preview_by_labels
@@ -298,7 +930,13 @@ class QqHTMLFormatter(object):
         self.label_to_title: Dict[str, str] = {}
         self.label_to_tag: Dict[str, QqTag] = {}
         self.label_to_chapter: Dict[str, int] = {}
+        # chapter index of labeled tag
+        self.label_to_tag_chapter: Dict[str, int] = {}
+        # indexes (in root) of chapter tags, see tag2chapter
+        self.chapter_bounds: List[int] = []
+        self.chapter_bounds_root: Optional[QqTag] = None
         self.flabel_to_tag: Dict[str, QqTag] = {}
+        self.flabel_index: Optional[FlabelIndex] = None
         self.root: QqTag = root
         self.counters = {}
         self.chapters: List[Chapter] = []
@@ -424,11 +1062,43 @@ class QqHTMLFormatter(object):
             self.counters[env].showparents = False
 
         self.figures_dir = None
+        # save frames of jsanimate videos to separate files in
+        # figures_dir instead of embedding them into HTML
+        self.jsanimate_external_frames = False
+        # render frames of videos separately (in animation_jobs
+        # processes) and cache them in cache_dir/frames,
+        # None to render videos with animation.save (it is used with
+        # unsupported matplotlib and in the sandbox too,
+        # see renders_frames)
+        self.animation_jobs: Optional[int] = None
+        # see figure_env_fingerprint
+        self._figure_env_fingerprint: Optional[str] = None
+        self._figure_env_rcparams: Dict[str, Any] = {}
+        self._figure_manifest: Optional[FigureManifest] = None
+
+        # rendered root-level blocks are cached in cache_dir/fragments,
+        # other output in the rest of cache_subdirs,
+        # None disables the cache
+        self.cache_dir: Optional[str] = None
+        # dependencies of the block being rendered, see handle_cached
+        self.dependencies: Optional[List[Tuple[tuple, Any]]] = None
+        # see subtree_digests
+        self.digests_memo: Dict[int, Tuple[QqTag, str]] = {}
 
         self.default_figname = "fig"
 
-        plt.rcParams["figure.figsize"] = (6, 4)
-        plt.rcParams["animation.frame_format"] = "svg"
+        # applied to plt.rcParams when assigned
+        self.figure_rcparams = {
+            "figure.figsize": (6, 4),
+            "animation.frame_format": "svg",
+        }
+
+        # highlight code of showcode blocks with pygments when
+        # rendering, instead of highlight.js in the browser
+        self.highlight_code = False
+        self.highlight_style = "default"
+        # hashsum of code block -> highlighted html, see highlight
+        self.highlight_cache: Dict[str, str] = {}
 
         self.pythonfigure_globals = {"plt": plt, "Camera": Camera}
         self.code_prefixes = dict(
@@ -451,6 +1121,22 @@ class QqHTMLFormatter(object):
         self.plotly_globals: Dict[str, Any] = {}
 
         self.python_globals: Dict[str, Any] = {}
+        # hashsum of pythoncode blocks executed since the last
+        # clearglobals and blocks that are taken from cache but not
+        # executed yet, see run_pythoncode
+        self.python_chain = ""
+        self.python_pending: List[str] = []
+        # worker processes to run pythoncode blocks and figures in,
+        # see make_sandboxes; None to run them in this process
+        self.python_sandbox: Optional[SandboxSession] = None
+        self.figure_sandbox: Optional[SandboxPool] = None
+        # figures of the formatting pass run one after another in one
+        # worker, so globals defined by a figure are seen by the next
+        # ones, as with pythonfigure_globals in this process
+        self.figure_session: Optional[SandboxSession] = None
+        # python_sandbox is used by this formatter, see hold_python_sandbox
+        self.python_sandbox_held = False
+        self.reset_python_globals()
 
         self.css: Dict[str, str] = {}
         self.js_top: Dict[str, str] = {}
@@ -503,6 +1189,153 @@ class QqHTMLFormatter(object):
     def url_for_img(self, s: str):
         return "/img/" + s
 
+    # subdirectories of cache_dir, files there are touched when used
+    # (see figmanifest.prune_cache)
+    cache_subdirs = (
+        "fragments",
+        "frames",
+        "plotly",
+        "pythoncode",
+        "highlight",
+    )
+
+    # bump to invalidate all rendered figures
+    figure_key_version = 2
+
+    # rcParams that don't change rendered figures
+    ignored_rcparams = (
+        "backend",
+        "interactive",
+        "keymap.",
+        "toolbar",
+        "webagg.",
+        "tk.",
+        "macosx.",
+        "figure.max_open_warning",
+        "figure.raise_window",
+        "savefig.directory",
+        "animation.ffmpeg_path",
+        "animation.convert_path",
+    )
+
+    @property
+    def figure_rcparams(self) -> Dict[str, Any]:
+        return self._figure_rcparams
+
+    @figure_rcparams.setter
+    def figure_rcparams(self, value: Dict[str, Any]) -> None:
+        self._figure_rcparams = value
+        plt.rcParams.update(value)
+        self._figure_env_fingerprint = None
+
+    @property
+    def pythonfigure_globals(self) -> Dict[str, Any]:
+        return self._pythonfigure_globals
+
+    @pythonfigure_globals.setter
+    def pythonfigure_globals(self, value: Dict[str, Any]) -> None:
+        self._pythonfigure_globals = value
+        self._figure_env_fingerprint = None
+        # code of figures executed in the globals,
+        # see run_preceding_figures
+        self.figures_executed: Set[str] = set()
+
+    def figure_env_fingerprint(self) -> str:
+        """
+        Hashsum of the environment that python figures are rendered in:
+        matplotlib version, rcParams in effect (plt.rcParams updated
+        with figure_rcparams), code prefixes and globals.
+
+        Computed on first use and then cached until figure_rcparams or
+        pythonfigure_globals are assigned, i.e. the environment should
+        be set up before the first figure is rendered. Names that
+        figure code itself adds to the globals are ignored.
+
+        :return:
+        """
+        if self._figure_env_fingerprint is None:
+            rcparams = {
+                name: value
+                for name, value in plt.rcParams.items()
+                if not name.startswith(self.ignored_rcparams)
+            }
+            rcparams.update(self.figure_rcparams)
+            env = [
+                self.figure_key_version,
+                matplotlib.__version__,
+                sorted(
+                    (name, repr(value)) for name, value in rcparams.items()
+                ),
+                self.code_prefixes.get("pythonfigure", ""),
+                self.code_prefixes.get("pythonvideo", ""),
+                globals_fingerprint(self.pythonfigure_globals),
+            ]
+            self._figure_env_rcparams = rcparams
+            self._figure_env_fingerprint = hashlib.md5(
+                repr(env).encode("utf8")
+            ).hexdigest()
+        return self._figure_env_fingerprint
+
+    def figure_env_rcparams(self) -> Dict[str, Any]:
+        """
+        rcParams that figure_env_fingerprint is based on, worker
+        processes render figures with them
+
+        :return:
+        """
+        self.figure_env_fingerprint()
+        return self._figure_env_rcparams
+
+    def python_fig_path(self, code: str, video=False) -> str:
+        """
+        Returns path of the figure directory relative to figures_dir.
+        It is based on hashsum of code, kind of figure and
+        figure_env_fingerprint.
+
+        :param code:
+        :param video: code produces animation
+        :return:
+        """
+        hashsum = hashlib.md5(
+            repr(
+                (code, "pythonvideo" if video else "pythonfigure",
+                 self.figure_env_fingerprint())
+            ).encode("utf8")
+        ).hexdigest()
+        return os.path.join(hashsum[:2], hashsum)
+
+    @property
+    def figure_manifest(self) -> Optional[FigureManifest]:
+        """
+        Manifest of figures in figures_dir, loaded on first use
+
+        :return: None if figures_dir is not set
+        """
+        if self.figures_dir is None:
+            return None
+        if (
+            self._figure_manifest is None
+            or self._figure_manifest.figures_dir != self.figures_dir
+        ):
+            self._figure_manifest = FigureManifest(self.figures_dir)
+        return self._figure_manifest
+
+    def python_fig_exists(self, relpath: str, exts: Tuple[str, ...]) -> bool:
+        manifest = self.figure_manifest
+        if manifest.has(relpath, exts):
+            return True
+        # figures rendered before the manifest appeared
+        path = os.path.join(self.figures_dir, relpath)
+        exists = all(
+            os.path.isfile(
+                os.path.join(path, self.default_figname + "." + ext)
+            )
+            for ext in exts
+        )
+        if exists:
+            manifest.add(relpath, exts)
+        return exists
+
     def make_python_fig(
         self,
         code: str,
@@ -510,60 +1343,379 @@ class QqHTMLFormatter(object):
         tight_layout=True,
         video=False,
     ) -> str:
-        hashsum = hashlib.md5(code.encode("utf8")).hexdigest()
-        prefix = hashsum[:2]
-        path = os.path.join(self.figures_dir, prefix, hashsum)
-        needfigure = False
-        for ext in exts:
-            if not os.path.isfile(
-                os.path.join(path, self.default_figname + "." + ext)
-            ):
-                needfigure = True
+        relpath = self.python_fig_path(code, video=video)
+        if not self.python_fig_exists(relpath, exts):
+            self.run_preceding_figures(code)
+            start = time.perf_counter()
+            if video and self.renders_frames():
+                self.render_animation_frames(
+                    code, os.path.join(self.figures_dir, relpath), exts
+                )
+            elif self.figure_session is not None:
+                self.figure_session.call(
+                    _session_figure_task,
+                    code,
+                    os.path.join(self.figures_dir, relpath),
+                    self.default_figname,
+                    exts,
+                    video,
+                )
+            else:
+                with exec_lock:
+                    self.figures_executed.add(code)
+                    render_python_fig(
+                        code,
+                        self.pythonfigure_globals,
+                        os.path.join(self.figures_dir, relpath),
+                        self.default_figname,
+                        exts,
+                        tight_layout=tight_layout,
+                        video=video,
+                    )
+            self.figure_manifest.add(
+                relpath, exts, time.perf_counter() - start
+            )
+            self.figure_manifest.save()
+
+        return relpath
+
+    def renders_frames(self) -> bool:
+        """
+        Videos are rendered frame by frame (see render_animation_frames)
+        if animation_jobs is set and matplotlib is supported. Frames
+        are not rendered in the sandbox: they are rendered in this
+        process or its children that have no limits, so sandboxed
+        videos are rendered in figure_session as a whole.
+
+        :return:
+        """
+        return (
+            self.animation_jobs is not None
+            and self.figure_session is None
+            and frames_supported()
+        )
+
+    def run_preceding_figures(self, code: str) -> None:
+        """
+        Executes figures of the document that precede the figure with
+        given code and were not executed in its globals: they exist
+        (rendered by prerender_figures, another process or another
+        run), but may define globals that this figure uses
+
+        :param code: code of the figure that is going to be rendered
+        """
+        if self.root is None:
+            return
+        preceding = []
+        for other, exts, video in self.python_figures(self.root):
+            if other == code:
                 break
+            preceding.append(other)
+        else:
+            # the figure is not in the document
+            return
+        if self.figure_session is not None:
+            self.figure_session.call(_session_preceding_task, preceding)
+        else:
+            with exec_lock:
+                exec_figures(
+                    preceding, self.pythonfigure_globals, self.figures_executed
+                )
 
-        if needfigure:
+    def render_animation_frames(
+        self, code: str, path: str, exts: Tuple[str, ...]
+    ) -> None:
+        """
+        Saves animation produced by code to path/figname.ext like
+        render_python_fig, but renders its frames separately,
+        in animation_jobs processes. Frames are cached in
+        cache_dir/frames, so only changed frames are rendered again.
+
+        :param code: python code that creates `animation` object
+        :param path: directory to save the video to
+        :param exts: "mp4", "jshtml" or "html", see render_python_fig
+        """
+        with contextlib.ExitStack() as stack:
+            if self.cache_dir is not None:
+                frames_dir = os.path.join(self.cache_dir, "frames")
+            else:
+                frames_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory()
+                )
             make_sure_path_exists(path)
-            gl = self.pythonfigure_globals
-            plt.close()
-            exec(code, gl)
-            if video:
-                animation = gl["animation"]
-                for ext in exts:
-                    animation.save(
-                        os.path.join(
-                            path, self.default_figname + "." + ext,
-                        ), bitrate=2000
+            for ext in exts:
+                filename = os.path.join(path, self.default_figname + "." + ext)
+                if ext in ("jshtml", "html"):
+                    fmt = plt.rcParams["animation.frame_format"]
+                else:
+                    fmt = "png"
+                fps, frames = self.render_frames_parallel(
+                    code, frames_dir, fmt, even_size=(ext == "mp4")
+                )
+                if ext == "jshtml":
+                    write_atomically(
+                        filename, stitch_jshtml(frames, fps, fmt)
                     )
+                elif ext == "html":
+                    stitch_html(frames, fps, fmt, filename)
+                else:
+                    stitch_mp4(frames, fps, filename)
+                remove_transient_frames(frames)
 
+    def render_frames_parallel(
+        self, code: str, frames_dir: str, fmt: str, even_size: bool
+    ) -> Tuple[float, List[str]]:
+        """
+        Every process executes code and renders its share of frames,
+        see render_frames
+
+        :return: (fps, paths of frames)
+        """
+        jobs = self.animation_jobs
+        if jobs == 1:
+            gl = self.pythonfigure_globals
+            with exec_lock:
+                plt.close()
+                exec(code, gl)
+                return (
+                    animation_fps(gl["animation"]),
+                    render_frames(
+                        gl["animation"],
+                        frames_dir,
+                        fmt,
+                        even_size=even_size,
+                    ),
+                )
+
+        modules, values = portable_globals(self.pythonfigure_globals)
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=figure_mp_context,
+            initializer=_init_figure_worker,
+            initargs=(modules, values, self.figure_env_rcparams()),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _render_frames_task,
+                    code,
+                    frames_dir,
+                    fmt,
+                    worker,
+                    jobs,
+                    even_size,
+                )
+                for worker in range(jobs)
+            ]
+            results = [future.result() for future in futures]
+        fps = results[0][0]
+        frames = [
+            next(path for path in paths if path is not None)
+            for paths in zip(*(frames for fps, frames in results))
+        ]
+        return fps, frames
+
+    def python_figures(
+        self, tag: QqTag
+    ) -> Iterator[Tuple[str, Tuple[str, ...], bool]]:
+        """
+        Yields (code, exts, video) for every python figure or video
+        inside tag, in the same form as they are passed to
+        make_python_fig by the handlers
+
+        :param tag:
+        :return:
+        """
+        for child in tag.children_tags():
+            if child.name == "hide":
+                continue
+            if child.name == "pythonfigure":
+                yield (
+                    child.text_content,
+                    (child.get("imgformat", "svg"),),
+                    False,
+                )
+            elif child.name == "pythonvideo":
+                if child.exists("jsanimate"):
+                    yield child.text_content, self.jsanimate_exts(), True
+                else:
+                    yield child.text_content, ("mp4",), True
             else:
-                if tight_layout:
-                    plt.tight_layout()
-                for ext in exts:
-                    plt.savefig(
-                        os.path.join(
-                            path, self.default_figname + "." + ext
-                        )
+                yield from self.python_figures(child)
+
+    def prerender_figures(
+        self, jobs: Optional[int] = None, tag: Optional[QqTag] = None
+    ) -> None:
+        """
+        Renders all missing python figures of self.root (or of tag)
+        in a process pool, so the formatting pass finds all of them
+        in figures_dir.
+
+        Figures that fail to render (e.g. because they use globals
+        defined by preceding figures, see run_preceding_figures) are
+        logged and left to the formatting pass that reports the error
+        as usual.
+
+        :param jobs: number of worker processes, os.cpu_count()
+                     if None. jobs=1 disables the pre-pass.
+        :param tag: part of the tree to render figures of
+        """
+        if jobs == 1:
+            return
+        if tag is None:
+            tag = self.root
+        missing = {}
+        for code, exts, video in self.python_figures(tag):
+            if video and self.renders_frames():
+                # frames of videos are rendered in parallel
+                # by the formatting pass
+                continue
+            relpath = self.python_fig_path(code, video=video)
+            if relpath in missing or self.python_fig_exists(relpath, exts):
+                continue
+            missing[relpath] = (code, exts, video)
+        if not missing:
+            return
+
+        if self.figure_sandbox is not None:
+            # the sandbox has its own processes with limits
+            executor = ThreadPoolExecutor(
+                max_workers=self.figure_sandbox.size
+            )
+
+            def submit(*args):
+                return executor.submit(
+                    self.figure_sandbox.call, _render_figure_task, *args
+                )
+
+        else:
+            modules, values = portable_globals(self.pythonfigure_globals)
+            executor = ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=figure_mp_context,
+                initializer=_init_figure_worker,
+                initargs=(modules, values, self.figure_env_rcparams()),
+            )
+
+            def submit(*args):
+                return executor.submit(_render_figure_task, *args)
+
+        with executor:
+            futures = {
+                submit(
+                    code,
+                    os.path.join(self.figures_dir, relpath),
+                    self.default_figname,
+                    exts,
+                    video,
+                ): relpath
+                for relpath, (code, exts, video) in missing.items()
+            }
+            for future in as_completed(futures):
+                relpath = futures[future]
+                try:
+                    render_time = future.result()
+                except Exception as e:
+                    logger.warning(
+                        "Figure %s is left to the formatting pass: %s: %s",
+                        relpath,
+                        e.__class__.__name__,
+                        e,
                     )
+                    continue
+                self.figure_manifest.add(
+                    relpath, missing[relpath][1], render_time
+                )
+        self.figure_manifest.save()
 
-        return os.path.join(prefix, hashsum)
+    def jsanimate_exts(self) -> Tuple[str, ...]:
+        """
+        Formats that jsanimate videos are rendered to, see
+        render_python_fig
+
+        :return:
+        """
+        if self.jsanimate_external_frames:
+            return ("html",)
+        return ("jshtml",)
 
     def make_python_jsanimate(self, code: str):
-        gl = self.pythonfigure_globals
-        plt.close()
-        exec(code, gl)
-        animation = gl["animation"]
-        anim_html = (animation.to_jshtml(default_mode="once")
-                     .replace("<img id=",
-                              '<img class="figure img-responsive" id='))
+        if self.figures_dir is None and self.figure_session is not None:
+            anim_html = self.figure_session.call(_session_jshtml_task, code)
+        elif self.figures_dir is None:
+            gl = self.pythonfigure_globals
+            with exec_lock:
+                plt.close()
+                exec(code, gl)
+                anim_html = gl["animation"].to_jshtml(default_mode="once")
+        else:
+            exts = self.jsanimate_exts()
+            relpath = self.make_python_fig(code, exts=exts, video=True)
+            path = os.path.join(self.figures_dir, relpath)
+            with open(
+                os.path.join(path, self.default_figname + "." + exts[0]),
+                encoding="utf-8",
+            ) as f:
+                anim_html = f.read()
+            # every player on the page should have its own ids
+            m = re.search(r"_anim_img([0-9a-f]{32})", anim_html)
+            if m:
+                anim_html = anim_html.replace(m.group(1), uuid.uuid4().hex)
+            if self.jsanimate_external_frames:
+                frames_dir = self.default_figname + "_frames"
+                # urls of all frames are passed to url_for_figure, so they
+                # are known to Frozen-Flask
+                frame_urls = [
+                    self.url_for_figure(
+                        relpath + "/" + frames_dir + "/" + name
+                    )
+                    for name in sorted(
+                        os.listdir(os.path.join(path, frames_dir))
+                    )
+                ]
+                if frame_urls:
+                    frames_url = frame_urls[0].rsplit("/", 1)[0]
+                    anim_html = anim_html.replace(
+                        '"{}/frame"'.format(frames_dir),
+                        '"{}/frame"'.format(frames_url),
+                    )
+
+        anim_html = anim_html.replace(
+            "<img id=", '<img class="figure img-responsive" id='
+        )
         # FIXME: find better way to fix classes here
 
         return anim_html
 
+    def plotly_fig_cache_path(self, code: str) -> Optional[str]:
+        """
+        Path of cached output of plotly code in cache_dir,
+        None if cache is disabled.
+
+        Key is based on code, plotly version and plotly_globals.
+
+        :param code:
+        :return:
+        """
+        if self.cache_dir is None:
+            return None
+        hashsum = hashlib.md5(
+            repr(
+                (
+                    code,
+                    plotly.__version__,
+                    self.code_prefixes.get("plotly", ""),
+                    globals_fingerprint(self.plotly_globals),
+                )
+            ).encode("utf8")
+        ).hexdigest()
+        return os.path.join(
+            self.cache_dir, "plotly", hashsum[:2], hashsum + ".html"
+        )
+
     def make_plotly_fig(self, code: str) -> str:
         global plotly
         if plotly is None:
             import plotly
-        loc: Dict[str, Any] = {}
         self.plotly_globals.update(
             {
                 "plot": self.plotly_plotter.plot,
@@ -571,30 +1723,78 @@ class QqHTMLFormatter(object):
                 "plotly": plotly,
             }
         )
-
-        gl = self.plotly_globals
-        exec(code, gl, loc)
         self.js_top["plotly"] = (
             "<script src='https://cdn.plot.ly/plotly-"
             "latest.min.js'></script>"
         )
-        return self.plotly_plotter.get_data()
 
-    def uses_tags(self) -> set:
-        members = inspect.getmembers(self, predicate=inspect.ismethod)
-        handles = [
-            member
-            for member in members
-            if (
-                member[0].startswith("handle_")
-                or member[0] == "make_numbers"
+        path = self.plotly_fig_cache_path(code)
+        if path is not None:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    cached = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                touch(path)
+                # every plot should have its own div id, even if the
+                # same code is used twice
+                ids: Dict[str, str] = {}
+                return plotly_div_id_re.sub(
+                    lambda m: ids.setdefault(m.group(0), str(uuid.uuid4())),
+                    cached,
+                )
+
+        if self.figure_sandbox is not None:
+            # plot, go and plotly are set up by the worker
+            modules, values = portable_globals(
+                {
+                    name: value
+                    for name, value in self.plotly_globals.items()
+                    if name not in ("plot", "go", "plotly")
+                }
             )
-        ]
+            output = self.figure_sandbox.call(
+                _sandbox_plotly_task, code, modules, values
+            )
+        else:
+            loc: Dict[str, Any] = {}
+            gl = self.plotly_globals
+            with exec_lock:
+                exec(code, gl, loc)
+            output = self.plotly_plotter.get_data()
+        if path is not None:
+            write_atomically(path, output)
+        return output
+
+    @classmethod
+    def handler_registry(
+        cls,
+    ) -> Tuple[Dict[str, Callable], FrozenSet[str]]:
+        """
+        Returns dict tag name -> handler (unbound ``handle_<name>`` method)
+        and set of tags mentioned in "Uses tags:" lines of docstrings.
+
+        Built once per class, so subclasses (that can override handlers)
+        get their own registry.
+
+        :return: (handlers, tags)
+        """
+        registry = cls.__dict__.get("_handler_registry")
+        if registry is not None:
+            return registry
+
+        handlers = {}
         alltags = set([])
-        for handle in handles:
-            if handle[0].startswith("handle_"):
-                alltags.add(handle[0][len("handle_") :])
-            doc = handle[1].__doc__
+        for name, member in inspect.getmembers(
+            cls, predicate=inspect.isfunction
+        ):
+            if name.startswith("handle_"):
+                handlers[name[len("handle_") :]] = member
+                alltags.add(name[len("handle_") :])
+            elif name != "make_numbers":
+                continue
+            doc = member.__doc__
             if not doc:
                 continue
             for line in doc.splitlines():
@@ -603,6 +1803,12 @@ class QqHTMLFormatter(object):
                     tags = m.group(1).split(",")
                     tags = [tag.strip() for tag in tags]
                     alltags.update(tags)
+        registry = (handlers, frozenset(alltags))
+        cls._handler_registry = registry
+        return registry
+
+    def uses_tags(self) -> set:
+        alltags = set(self.handler_registry()[1])
         alltags.update(self.enumerateable_envs.keys())
         alltags.update(self.metatags)
         return alltags
@@ -616,13 +1822,13 @@ class QqHTMLFormatter(object):
 
     def handle(self, tag: QqTag) -> str:
         name = tag.name
-        default_handler = "handle_" + name
         if name in self.heading_to_level:
             return self.handle_heading(tag)
         elif name in self.enumerateable_envs:
             return self.handle_enumerateable(tag)
-        elif hasattr(self, default_handler):
-            return getattr(self, default_handler)(tag)
+        handler = self.handler_registry()[0].get(name)
+        if handler is not None:
+            return handler(self, tag)
         else:
             return ""
 
@@ -664,10 +1870,273 @@ class QqHTMLFormatter(object):
                     )
                 else:
                     out.append(html_escape(child))
+            elif self.cache_dir is not None and child.parent is self.root:
+                out.append(self.handle_cached(child))
             else:
                 out.append(self.handle(child))
         return "".join(out)
 
+    # tags whose output depends on state shared between blocks
+    uncacheable_tags = {"pythoncode", "plotly"}
+
+    url_methods = (
+        "url_for_chapter_by_index",
+        "url_for_chapter_by_label",
+        "url_for_snippet",
+        "url_for_eq_snippet",
+        "url_for_figure",
+        "url_for_img",
+    )
+
+    def fragment_cacheable(self, tag: QqTag) -> bool:
+        """
+        Block can be taken from cache if it has no tags with side effects
+        and all its python figures are rendered
+
+        :param tag: root-level block
+        :return:
+        """
+        stack = [tag]
+        while stack:
+            current = stack.pop()
+            if current.name in self.uncacheable_tags:
+                return False
+            stack.extend(current.children_tags())
+        return all(
+            self.python_fig_exists(
+                self.python_fig_path(code, video=video), exts
+            )
+            for code, exts, video in self.python_figures(tag)
+        )
+
+    @classmethod
+    def source_fingerprint(cls) -> str:
+        """
+        Hashsum of sources of modules that define formatter class
+        and its bases, and of templates. Changes when handlers change.
+
+        :return:
+        """
+        fingerprint = cls.__dict__.get("_source_fingerprint")
+        if fingerprint is not None:
+            return fingerprint
+        hasher = hashlib.sha256()
+        modules = []
+        for klass in cls.__mro__:
+            module = sys.modules.get(klass.__module__)
+            if module is not None and module not in modules:
+                modules.append(module)
+        for module in modules:
+            try:
+                hasher.update(inspect.getsource(module).encode("utf-8"))
+            except (OSError, TypeError):
+                hasher.update(module.__name__.encode("utf-8"))
+        templates_dir = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "templates"
+        )
+        for name in sorted(os.listdir(templates_dir)):
+            with open(os.path.join(templates_dir, name), "rb") as f:
+                hasher.update(f.read())
+        fingerprint = hasher.hexdigest()
+        cls._source_fingerprint = fingerprint
+        return fingerprint
+
+    def fragment_context(self) -> tuple:
+        """
+        Everything besides the block itself and its dependencies
+        that rendered block depends on
+
+        :return:
+        """
+        return (
+            self.source_fingerprint(),
+            self.mode,
+            self.with_chapters,
+            self.eq_preview_by_labels,
+            self.root.meta_.get("lang") if self.root else None,
+            sorted(self.enumerateable_envs.items()),
+            sorted(self.code_prefixes.items()),
+            self.default_figname,
+            self.figure_env_fingerprint(),
+            self.jsanimate_external_frames,
+            self.highlight_code,
+            self.highlight_style,
+        )
+
+    def fragment_key(self, tag: QqTag) -> str:
+        chapter = (
+            self.eve2chapter(tag) if self.mode == "bychapters" else None
+        )
+        return hashlib.sha256(
+            repr(
+                (self.tag_digest(tag), chapter, self.fragment_context())
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def dependency_value(self, dependency: tuple) -> Any:
+        """
+        Returns current value of dependency recorded while rendering
+        a block:
+
+        - ("ref", label): everything handle_ref uses about label;
+        - ("flabel", s): label of tag found by flabel s;
+        - ("url", method name, args): result of url_for_* method.
+
+        :param dependency:
+        :return:
+        """
+        kind = dependency[0]
+        if kind == "ref":
+            label = dependency[1]
+            value = [
+                self.label_to_number.get(label),
+                self.label_to_title.get(label),
+            ]
+            target = self.label_to_tag.get(label)
+            if target is not None:
+                value.append(target.name)
+                value.append(target.parent.name if target.parent else None)
+                if self.mode == "bychapters":
+                    index = self.label2chapter(label)
+                    value.append(index)
+                    value.append(self.chapters[index].heading.get("label"))
+            return value
+        if kind == "flabel":
+            target = self.find_tag_by_flabel(dependency[1])
+            return target.get("label") if target is not None else None
+        if kind == "url":
+            return self.call_url_method(
+                getattr(self, dependency[1]), dependency[2]
+            )
+        raise ValueError("Unknown dependency " + repr(dependency))
+
+    @staticmethod
+    def call_url_method(method: Callable, args: tuple) -> tuple:
+        try:
+            return "ok", method(*args)
+        except Exception as e:
+            return "error", type(e).__name__
+
+    def note_dependency(self, dependency: tuple) -> None:
+        if self.dependencies is not None:
+            self.dependencies.append(
+                (dependency, self.dependency_value(dependency))
+            )
+
+    def recording_url_method(self, name: str) -> Callable:
+        method = getattr(self, name)
+
+        def record(args, value):
+            if self.dependencies is not None:
+                self.dependencies.append((("url", name, args), value))
+
+        def wrapper(*args):
+            try:
+                result = method(*args)
+            except Exception as e:
+                record(args, ("error", type(e).__name__))
+                raise
+            record(args, ("ok", result))
+            return result
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def recording_dependencies(self):
+        """
+        Records dependencies of formatted content to the yielded list
+
+        :return:
+        """
+        outer = self.dependencies
+        self.dependencies = dependencies = []
+        if outer is None:
+            for name in self.url_methods:
+                setattr(self, name, self.recording_url_method(name))
+        try:
+            yield dependencies
+        finally:
+            if outer is None:
+                for name in self.url_methods:
+                    delattr(self, name)
+            else:
+                outer.extend(dependencies)
+            self.dependencies = outer
+
+    asset_names = ("css", "js_top", "js_bottom", "js_onload")
+
+    @contextlib.contextmanager
+    def collect_assets(self, propagate: bool = True):
+        """
+        Collects css and js added by formatted content to the yielded
+        dict (asset name -> dict)
+
+        :param propagate: add collected assets to the outer ones too.
+            Pass False to start a render scope of its own (a chapter
+            or a snippet), so the assets it needs are not included
+            into the pages rendered after it
+        :return:
+        """
+        outer = {name: getattr(self, name) for name in self.asset_names}
+        collected: Dict[str, Dict[str, str]] = {
+            name: {} for name in self.asset_names
+        }
+        for name in self.asset_names:
+            setattr(self, name, collected[name])
+        try:
+            yield collected
+        finally:
+            for name in self.asset_names:
+                if propagate:
+                    outer[name].update(collected[name])
+                setattr(self, name, outer[name])
+
+    def handle_cached(self, tag: QqTag) -> str:
+        """
+        Same as handle, but takes the result from cache_dir if the
+        block is not changed and everything it refers to
+        (numbers, chapters, urls) is the same
+
+        :param tag: root-level block
+        :return:
+        """
+        if not self.fragment_cacheable(tag):
+            return self.handle(tag)
+        key = self.fragment_key(tag)
+        path = os.path.join(
+            self.cache_dir, "fragments", key[:2], key + ".pickle"
+        )
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            entry = None
+        if entry is not None and all(
+            self.dependency_value(dependency) == value
+            for dependency, value in entry["dependencies"]
+        ):
+            touch(path)
+            for name, assets in entry["assets"].items():
+                getattr(self, name).update(assets)
+            return entry["html"]
+
+        with self.collect_assets() as assets:
+            with self.recording_dependencies() as dependencies:
+                html = self.handle(tag)
+
+        write_atomically(
+            path,
+            pickle.dumps(
+                {
+                    "html": html,
+                    "assets": assets,
+                    "dependencies": dependencies,
+                }
+            ),
+            mode="wb",
+        )
+        return html
+
     def handle_heading(self, tag: QqTag) -> str:
         """
         Uses tags: chapter, section, subsection, subsubsection
@@ -751,30 +2220,13 @@ class QqHTMLFormatter(object):
             text("\\]\n")
         return doc.getvalue()
 
+    def get_template(self, name: str) -> Template:
+        return get_template_lookup(
+            self.templates_dir, self.templates_module_dir
+        ).get_template(name)
+
     def multieq_template(self, name: str, tag: QqTag) -> str:
-        template = Template(
-            dedent(
-                r"""
-                \[
-                \begin{${name}}
-                <% items = tag("item") %>
-                % if items:
-                    % for i, item in enumerate(items):
-                        ${formatter.format(item, blanks_to_pars=False)}
-                        % if item.exists("number"):
-                            \tag{${item.number_.value}}
-                        % endif
-                        % if i != len(items) - 1:
-                            \\\
-                        
-                        % endif
-                        % endfor
-                % endif
-                \end{${name}}
-                \]
-                """
-            )
-        )
+        template = self.get_template("multieq")
         if tag.exists("splitem"):
             long_tag, splitted_tag = extract_splitted_items(tag)
             long_name = tag.get("longenv", name)
@@ -882,19 +2334,21 @@ class QqHTMLFormatter(object):
 
             prefix, label = tag.children_values(not_simple="keep")
 
+        self.note_dependency(("ref", label))
         number = self.label_to_number.get(label, "[" + label + "]")
         target = self.label_to_tag.get(label)
 
         href = ""
         if self.mode == "bychapters":
-            if "snippet" not in [t.name for t in tag.ancestor_path()]:
+            path = tag.ancestor_path()
+            if "snippet" not in [t.name for t in path]:
                 # check that we're not inside snippet now
-                fromindex = self.tag2chapter(tag)
+                fromindex = self.eve2chapter(path[-2])
             else:
                 fromindex = None
             href = (
                 self.url_for_chapter(
-                    self.tag2chapter(target), fromindex=fromindex
+                    self.label2chapter(label), fromindex=fromindex
                 )
                 if target
                 else ""
@@ -970,6 +2424,7 @@ class QqHTMLFormatter(object):
             tag = tag.unitemized()
         if tag.is_simple:
             title = tag.value.replace("\n", " ")
+            self.note_dependency(("flabel", title))
             target = self.find_tag_by_flabel(title)
             label = target.label_.value
         else:
@@ -1301,21 +2756,191 @@ class QqHTMLFormatter(object):
             )
 
         if tag.exists("clearglobals"):
-            self.python_globals.clear()
+            self.reset_python_globals()
 
         if not tag.exists("donotrun"):
-            with stdout_io() as s:
-                try:
-                    exec(tag.text_content, self.python_globals)
-                except Exception as e:
-                    print(
-                        "Exception: {}\n{}".format(e.__class__.__name__, e)
-                    )
             with html("pre"):
                 with html("code", klass="lang-python"):
-                    doc.asis(s.getvalue())
+                    doc.asis(self.run_pythoncode(tag.text_content))
         return doc.getvalue()
 
+    def reset_python_globals(self) -> None:
+        """
+        Clears globals of pythoncode blocks
+        """
+        self.python_globals.clear()
+        if self.python_sandbox_held:
+            self.python_sandbox.reset(_sandbox_reset_pythoncode)
+        self.python_chain = hashlib.md5(
+            repr(("pythoncode", sys.version)).encode("utf8")
+        ).hexdigest()
+        self.python_pending.clear()
+
+    def exec_pythoncode(self, code: str) -> str:
+        """
+        Executes code in python_globals or in python_sandbox
+
+        :param code:
+        :return: captured output
+        """
+        if self.python_sandbox is None:
+            with exec_lock:
+                return exec_captured(code, self.python_globals)
+        self.hold_python_sandbox()
+        try:
+            return self.python_sandbox.call(_sandbox_exec_pythoncode, code)
+        except Exception as e:
+            return format_exception(e)
+
+    def hold_python_sandbox(self) -> None:
+        """
+        Globals of pythoncode blocks live in python_sandbox, so it is
+        used by one formatter (see clone) at a time: it is held from
+        the first pythoncode block until release_python_sandbox and
+        starts with clear globals
+        """
+        if self.python_sandbox is None or self.python_sandbox_held:
+            return
+        self.python_sandbox.lock.acquire()
+        self.python_sandbox_held = True
+        self.python_sandbox.reset(_sandbox_reset_pythoncode)
+
+    def release_python_sandbox(self) -> None:
+        if self.python_sandbox_held:
+            self.python_sandbox_held = False
+            self.python_sandbox.lock.release()
+
+    def make_sandboxes(
+        self,
+        size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        memory_limit: Optional[int] = None,
+        max_tasks: Optional[int] = None,
+    ) -> Tuple[SandboxSession, SandboxPool, SandboxSession]:
+        """
+        Creates worker processes for pythoncode blocks and figures
+        (see sandbox module). Figure workers get portable part of
+        pythonfigure_globals, so the globals should be set up before.
+
+        Figures missing at formatting are rendered in figure_session
+        that keeps globals between them; figure_sandbox renders
+        figures of prerender_figures in parallel.
+
+        :param size: number of figure workers, os.cpu_count() if None
+        :param timeout: limit of execution time per block, seconds
+        :param memory_limit: limit of worker memory, bytes
+        :param max_tasks: recycle worker after this number of tasks
+        :return: (python_sandbox, figure_sandbox, figure_session)
+        """
+        limits = dict(
+            timeout=timeout, memory_limit=memory_limit, max_tasks=max_tasks
+        )
+        modules, values = portable_globals(self.pythonfigure_globals)
+        initargs = (modules, values, self.figure_env_rcparams())
+        return (
+            SandboxSession(**limits),
+            SandboxPool(
+                size=size or os.cpu_count() or 1,
+                initializer=_init_figure_worker,
+                initargs=initargs,
+                **limits
+            ),
+            SandboxSession(
+                initializer=_init_figure_worker, initargs=initargs, **limits
+            ),
+        )
+
+    def run_pythoncode(self, code: str) -> str:
+        """
+        Executes code of pythoncode block and returns its output.
+
+        If cache_dir is set, output is cached under the key that
+        depends on this block and all blocks executed before it since
+        the last clearglobals. Blocks that are found in cache are not
+        executed until some block after them is not found.
+
+        :param code:
+        :return: captured output
+        """
+        self.python_chain = hashlib.md5(
+            (self.python_chain + code).encode("utf8")
+        ).hexdigest()
+        if self.cache_dir is None:
+            self.exec_python_pending()
+            return self.exec_pythoncode(code)
+
+        key = self.python_chain
+        path = os.path.join(
+            self.cache_dir, "pythoncode", key[:2], key + ".txt"
+        )
+        try:
+            with open(path, encoding="utf-8") as f:
+                output = f.read()
+        except FileNotFoundError:
+            pass
+        else:
+            touch(path)
+            self.python_pending.append(code)
+            return output
+
+        self.exec_python_pending()
+        output = self.exec_pythoncode(code)
+        write_atomically(path, output)
+        return output
+
+    def exec_python_pending(self) -> None:
+        """
+        Executes blocks of python_pending to restore globals that
+        the next block may depend on
+        """
+        for pending in self.python_pending:
+            self.exec_pythoncode(pending)
+        self.python_pending.clear()
+
+    def replay_pythoncode(self, tag: QqTag) -> None:
+        """
+        Brings the state of pythoncode blocks to the one after
+        formatting tag (e.g. the chapters that precede the one that
+        is rendered). Blocks are not executed here: they are added
+        to python_pending, see run_pythoncode
+
+        :param tag:
+        """
+        for child in tag.children_tags():
+            if child.name == "hide":
+                continue
+            if child.name != "pythoncode":
+                self.replay_pythoncode(child)
+                continue
+            if child.exists("clearglobals"):
+                self.reset_python_globals()
+            if not child.exists("donotrun"):
+                code = child.text_content
+                self.python_chain = hashlib.md5(
+                    (self.python_chain + code).encode("utf8")
+                ).hexdigest()
+                self.python_pending.append(code)
+
+    def replay_preceding_chapters(self, index: int) -> None:
+        """
+        replay_pythoncode for the chapters before chapter index,
+        so its blocks see their globals, as when the book is formatted
+        as a whole
+
+        :param index:
+        """
+        self.replay_pythoncode(
+            QqTag(
+                "_chapters",
+                [
+                    child
+                    for chapter in self.chapters[:index]
+                    for child in chapter.content
+                ],
+                adopt=True,
+            )
+        )
+
     def handle_plotly(self, tag: QqTag) -> str:
         return "".join(self.make_plotly_fig(tag.text_content))
 
@@ -1355,23 +2980,27 @@ class QqHTMLFormatter(object):
                 :return:
         """
 
-        self.css["highlightjs"] = (
-            '<link rel="stylesheet" '
-            'href="https://cdnjs.cloudflare.com/ajax/libs/'
-            'highlight.js/9.2.0/styles/default.min.css">\n'
-            '<style type="text/css">\n'
-            ".hljs {background: inherit;}\n"
-            "</style>\n"
-        )
-        self.js_top["highlightjs"] = (
-            '<script src="https://cdnjs.cloudflare.com/ajax/libs/'
-            'highlight.js/10.5.0/highlight.min.js"></script>\n'
-            "<script>hljs.initHighlightingOnLoad();</script>\n"
-            '<script charset="UTF-8" src="https://cdnjs.cloudflare.com/'
-            'ajax/libs/highlight.js/10.5.0/languages/latex.min.js"></script>\n'
-        )
+        if self.highlight_code:
+            self.css["pygments"] = self.highlight_css()
+        else:
+            self.css["highlightjs"] = (
+                '<link rel="stylesheet" '
+                'href="https://cdnjs.cloudflare.com/ajax/libs/'
+                'highlight.js/9.2.0/styles/default.min.css">\n'
+                '<style type="text/css">\n'
+                ".hljs {background: inherit;}\n"
+                "</style>\n"
+            )
+            self.js_top["highlightjs"] = (
+                '<script src="https://cdnjs.cloudflare.com/ajax/libs/'
+                'highlight.js/10.5.0/highlight.min.js"></script>\n'
+                "<script>hljs.initHighlightingOnLoad();</script>\n"
+                '<script charset="UTF-8" src="https://cdnjs.cloudflare.com/'
+                "ajax/libs/highlight.js/10.5.0/languages/latex.min.js"
+                '"></script>\n'
+            )
         self.js_onload[
-            "highlightjs"
+            "showcode"
         ] = """
         function toggle_block(obj, show) {
           var span = obj.find('span');
@@ -1410,13 +3039,23 @@ class QqHTMLFormatter(object):
             if collapsed:
                 doc.attr(style="display:none")
             with html("code"):
-                if lang:
-                    doc.attr(klass="lang-" + lang)
+                if self.highlight_code:
+                    doc.attr(klass="highlight")
+                    doc.asis(
+                        self.highlight(
+                            self.code_prefixes.get(tag.name, "")
+                            + tag.text_content,
+                            lang,
+                        )
+                    )
+                else:
+                    if lang:
+                        doc.attr(klass="lang-" + lang)
 
-                doc.asis(self.code_prefixes.get(tag.name, ""))
-                # add a prefix if exists
+                    doc.asis(self.code_prefixes.get(tag.name, ""))
+                    # add a prefix if exists
 
-                text(tag.text_content)
+                    text(tag.text_content)
 
         return (
             "<div style='text-align: left'>"
@@ -1425,6 +3064,71 @@ class QqHTMLFormatter(object):
             + "</div>"
         )
 
+    def highlight(self, code: str, lang: Optional[str] = None) -> str:
+        """
+        Highlights code with pygments, see highlight_code.
+
+        Result is cached in memory and, if cache_dir is set,
+        in cache_dir/highlight under the hashsum of the code block.
+
+        :param code:
+        :param lang: pygments lexer name, guessed from the code if None
+            or unknown
+        :return: html of code tokens without enclosing <pre>
+        """
+        import_pygments()
+        key = hashlib.md5(
+            repr((code, lang, pygments.__version__)).encode("utf8")
+        ).hexdigest()
+        output = self.highlight_cache.get(key)
+        if output is not None:
+            return output
+
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(
+                self.cache_dir, "highlight", key[:2], key + ".html"
+            )
+            try:
+                with open(path, encoding="utf-8") as f:
+                    output = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                touch(path)
+        if output is None:
+            try:
+                if lang is None:
+                    lexer = pygments.lexers.guess_lexer(code)
+                else:
+                    lexer = pygments.lexers.get_lexer_by_name(lang)
+            except pygments.util.ClassNotFound:
+                lexer = pygments.lexers.TextLexer()
+            output = pygments.highlight(
+                code, lexer, pygments.formatters.HtmlFormatter(nowrap=True)
+            )
+            if path is not None:
+                write_atomically(path, output)
+        self.highlight_cache[key] = output
+        return output
+
+    def highlight_css(self) -> str:
+        """
+        Style of code highlighted by highlight, see highlight_style
+
+        :return:
+        """
+        import_pygments()
+        return (
+            '<style type="text/css">\n'
+            + "\n".join(
+                pygments.formatters.HtmlFormatter(
+                    style=self.highlight_style
+                ).get_token_style_defs("code.highlight")
+            )
+            + "\n</style>\n"
+        )
+
     def handle_snippet(self, tag: QqTag) -> str:
         """
         Uses tags: hidden, backref, label, nobackref
@@ -1534,12 +3238,64 @@ class QqHTMLFormatter(object):
                 continue
             return None
 
+    def clone(self) -> "QqHTMLFormatter":
+        """
+        Returns formatter that shares the tree, numbers, labels,
+        chapters and caches with this one, but has its own assets and
+        python state, so several clones can format the same numbered
+        tree concurrently
+
+        :return:
+        """
+        # computed on first use: do it once for all clones
+        self.figure_env_fingerprint()
+        self.figure_manifest
+        formatter = copy.copy(self)
+        for name in self.asset_names:
+            setattr(formatter, name, {})
+        formatter.dependencies = None
+        formatter.plotly_plotter = PlotlyPlotter()
+        formatter.plotly_globals = dict(self.plotly_globals)
+        formatter.python_globals = {}
+        formatter.python_pending = []
+        formatter.python_sandbox_held = False
+        formatter.reset_python_globals()
+        return formatter
+
+    @contextlib.contextmanager
+    def rendering(self):
+        """
+        Yields clone of the formatter for one rendering job
+        (e.g. one request), see clone
+
+        :return:
+        """
+        formatter = self.clone()
+        try:
+            yield formatter
+        finally:
+            formatter.release_python_sandbox()
+
+    def clear_assets(self) -> None:
+        """
+        Forgets css and js collected while formatting
+
+        :return:
+        """
+        for name in self.asset_names:
+            getattr(self, name).clear()
+
     def make_numbers(self, tag: QqTag) -> None:
         """
         Uses tags: number, label, nonumber, flabel
 
         :return:
         """
+        # numbers are added to the tree
+        self.digests_memo.clear()
+        self._make_numbers(tag)
+
+    def _make_numbers(self, tag: QqTag) -> None:
         for child in tag.children_tags():
             name = child.name
             if name == 'hide':
@@ -1563,12 +3319,13 @@ class QqHTMLFormatter(object):
                 self.label_to_tag[child.label_.value] = child
             if child.find("flabel"):
                 self.flabel_to_tag[child.flabel_.value.lower()] = child
-            self.make_numbers(child)
+                self.flabel_index = None
+            self._make_numbers(child)
 
     def find_tag_by_flabel(self, s: str) -> QqTag:
-        flabel = process.extractOne(s.lower(), self.flabel_to_tag.keys())[
-            0
-        ]
+        if self.flabel_index is None:
+            self.flabel_index = FlabelIndex(self.flabel_to_tag.keys())
+        flabel = self.flabel_index.find(s.lower())
         return self.flabel_to_tag.get(flabel)
 
     def make_chapters(self):
@@ -1580,6 +3337,14 @@ class QqHTMLFormatter(object):
             zero_delim=QqTag("_zero_chapter"),
         ):
             self.add_chapter(Chapter(heading, [heading] + contents))
+        self.make_chapter_bounds()
+
+    def make_chapter_bounds(self) -> None:
+        self.chapter_bounds = sorted(
+            chapter.idx for chapter in self.root("chapter")
+        )
+        self.chapter_bounds_root = self.root
+        self.label_to_tag_chapter = {}
 
     def tag2chapter(self, tag) -> int:
         """
@@ -1592,18 +3357,34 @@ class QqHTMLFormatter(object):
         :param tag:
         :return:
         """
+        return self.eve2chapter(tag.get_eve())
+
+    def eve2chapter(self, eve: QqTag) -> int:
+        """
+        Returns the number of chapter to which eve (direct child of root)
+        belongs.
 
-        eve = tag.get_eve()
-        chapters = self.root("chapter")
+        :param eve:
+        :return:
+        """
+        if self.chapter_bounds_root is not self.root:
+            self.make_chapter_bounds()
+        return bisect.bisect_right(self.chapter_bounds, eve.idx)
 
-        return next(
-            (
-                i - 1
-                for i, chapter in enumerate(chapters, 1)
-                if eve.idx < chapter.idx
-            ),
-            len(chapters),
-        )
+    def label2chapter(self, label: str) -> int:
+        """
+        Returns the number of chapter to which tag with label belongs.
+
+        :param label:
+        :return:
+        """
+        if self.chapter_bounds_root is not self.root:
+            self.make_chapter_bounds()
+        index = self.label_to_tag_chapter.get(label)
+        if index is None:
+            index = self.tag2chapter(self.label_to_tag[label])
+            self.label_to_tag_chapter[label] = index
+        return index
 
     def url_for_chapter(
         self, index=None, label=None, fromindex=None
@@ -1808,7 +3589,11 @@ class QqHTMLFormatter(object):
         return toc
 
     def format_toc(
-        self, toc: TOCItem, fromchapter: int = None, tochapter: int = None
+        self,
+        toc: TOCItem,
+        fromchapter: int = None,
+        tochapter: int = None,
+        strings: Optional[Dict[int, str]] = None,
     ) -> FormattedTOCItem:
         """
         Formats toc obtained with extract_toc()
@@ -1820,12 +3605,20 @@ class QqHTMLFormatter(object):
         :param tochapter: chapter we render now,
                           None if we render contents
                           for the whole book
+        :param strings: formatted headings (id of tag -> html),
+                        to format the same toc for several chapters
+                        without formatting headings again
         :return:
         """
 
         ftoc = FormattedTOCItem()
         if toc.tag:
-            ftoc.string = self.format(toc.tag, blanks_to_pars=False)
+            string = None if strings is None else strings.get(id(toc.tag))
+            if string is None:
+                string = self.format(toc.tag, blanks_to_pars=False)
+                if strings is not None:
+                    strings[id(toc.tag)] = string
+            ftoc.string = string
             targetpage = self.url_for_chapter(
                 index=tochapter, fromindex=fromchapter
             )
@@ -1839,21 +3632,33 @@ class QqHTMLFormatter(object):
 
             ftoc.append_child(
                 self.format_toc(
-                    heading, fromchapter=fromchapter, tochapter=tochapter
+                    heading,
+                    fromchapter=fromchapter,
+                    tochapter=tochapter,
+                    strings=strings,
                 )
             )
         return ftoc
 
+    def tag_digest(self, tag: QqTag) -> str:
+        """
+        Returns MD5-hashsum of tag's subtree, memoized until
+        the next make_numbers (see subtree_digests)
+
+        :param tag:
+        :return:
+        """
+        return subtree_digests(tag, self.digests_memo)
+
     @staticmethod
     def tag_hash_id(tag: QqTag) -> str:
         """
         Returns autogenerated tag id based on tag's contents.
         It's first 5 characters of MD5-hashsum of tag's content
+        (see subtree_digests; formatter uses memoized tag_digest)
         :return:
         """
-        return hashlib.md5(
-            repr(tag.as_list()).encode("utf-8")
-        ).hexdigest()[:5]
+        return subtree_digests(tag)[:5]
 
     def handle_quiz(self, tag: QqTag) -> str:
         """
@@ -1874,12 +3679,12 @@ class QqHTMLFormatter(object):
         :param tag:
         :return:
         """
-        if not tag.exists("md5id"):
-            tag.append_child(QqTag("md5id", [self.tag_hash_id(tag)]))
-        template = Template(
-            filename=os.path.join(self.templates_dir, "quiz.html")
-        )
-        return template.render(formatter=self, tag=tag)
+        if tag.exists("md5id"):
+            quiz_id = tag.md5id_.value
+        else:
+            quiz_id = self.tag_digest(tag)[:5]
+        template = self.get_template("quiz.html")
+        return template.render(formatter=self, tag=tag, quiz_id=quiz_id)
 
     def handle_rawhtml(self, tag: QqTag) -> str:
         return tag.text_content
@@ -3,6 +3,13 @@
 
 from indentml.parser import QqParser, QqTag
 from qqmbr.qqhtml import QqHTMLFormatter
+from qqmbr.mjnode import (
+    MathJaxPool,
+    FormulaCache,
+    build_eq_index,
+    typeset_page,
+)
+from qqmbr.figmanifest import prune_cache
 import qqmbr.odebook as odebook
 import os
 import numpy
@@ -12,58 +19,96 @@ from flask import (
     abort,
     send_from_directory,
     url_for,
+    current_app,
+    has_request_context,
 )
-from subprocess import Popen, PIPE
-from bs4 import BeautifulSoup
 import shutil
+import atexit
+import contextlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import itertools
 import argparse
 from flask_frozen import Freezer
 import re
 from textwrap import dedent
 import json
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 import sys
 
 print(sys.executable)
 
 scriptdir = os.path.dirname(os.path.realpath(__file__))
-curdir = os.getcwd()
-
-app = Flask(__name__, static_url_path="")
 
-app.config["mjpage"] = os.path.join(
-    scriptdir, "../third-party/node_modules/mathjax-node-page/bin/mjpage"
+RenderedChapter = NamedTuple(
+    "RenderedChapter",
+    (
+        ("html", str),
+        # asset name -> dict, see QqHTMLFormatter.collect_assets
+        ("assets", Dict[str, Dict[str, str]]),
+        # url_for calls (endpoint, values) made while rendering,
+        # Frozen-Flask has to see them
+        ("url_for_calls", List[tuple]),
+    ),
 )
 
 
-app.config["mathjax_node"] = False
-app.config[
-    "css_correction"
-] = r"""
-<style type='text/css'>
-.mjx-chtml {
-font-size: 120%;
-}
-</style>
-<!-- 
-<script type="text/javascript" src="http://livejs.com/live.js"></script>
--->
-"""
-app.config["MATHJAX_WHOLEBOOK"] = False
-
-app.debug = True
-wholebook = None
-tree = None
-formatter = None
-
-app.config["FILE"] = None
+class Book(object):
+    """
+    Rendered state of the book. Tree and formatter are not changed
+    after load_book: pages are formatted by clones of the formatter
+    (see QqHTMLFormatter.rendering) and changed book is loaded as
+    a new Book, so requests can be handled concurrently.
+
+    Every chapter is rendered once (see BookApp.render_chapter).
+    The whole book is made of the rendered chapters when it is needed
+    (see BookApp.render_wholebook), in preview it is not rendered
+    before the first page is served.
+    """
+
+    def __init__(
+        self, tree: QqTag, formatter: QqHTMLFormatter, stamps: List[tuple]
+    ) -> None:
+        self.tree = tree
+        self.formatter = formatter
+        # (path, mtime_ns, size) of every file the tree is built from
+        self.stamps = stamps
+        # extracted once and formatted for every chapter
+        self.toc = formatter.extract_toc(maxlevel=3)
+        self.chapters_toc = formatter.extract_toc(maxlevel=1)
+        # see QqHTMLFormatter.format_toc
+        self.toc_strings: Dict[int, str] = {}
+        self.chapters: Dict[int, RenderedChapter] = {}
+        self.chapter_locks: Dict[int, threading.Lock] = {}
+        # None until render_wholebook
+        self.wholebook: Optional[str] = None
+        self.wholebook_style = ""
+        self.eq_index: Dict[str, str] = {}
+        self.wholebook_lock = threading.Lock()
+        # background thread that prepares the book, see BookApp.warm_up
+        self.warming: Optional[threading.Thread] = None
+        self.warming_lock = threading.Lock()
+
+    def chapter_lock(self, index: int) -> threading.Lock:
+        return self.chapter_locks.setdefault(index, threading.Lock())
 
 
 class QqFlaskHTMLFormatter(QqHTMLFormatter):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.figures_dir = os.path.join(curdir, "fig")
+        root = config["root"]
+        self.figures_dir = os.path.join(root, "fig")
+        self.templates_module_dir = os.path.join(root, ".qqcache", "mako")
+        self.cache_dir = config.get("cache_dir")
+        self.jsanimate_external_frames = config.get(
+            "jsanimate_external_frames", False
+        )
+        self.animation_jobs = config.get("animation_jobs")
+        self.highlight_code = config.get("highlight_code", False)
+        if config.get("highlight_style"):
+            self.highlight_style = config["highlight_style"]
 
     def url_for_chapter_by_index(self, index):
         return url_for("show_chapter_by_index", index=index)
@@ -84,40 +129,35 @@ class QqFlaskHTMLFormatter(QqHTMLFormatter):
         return url_for("show_eq", eq_id=eq_id)
 
 
-@app.route("/fig/<path:path>")
 def send_fig(path):
-    return send_from_directory(os.path.join(curdir, "fig"), path)
+    return send_from_directory(
+        os.path.join(current_app.config["root"], "fig"), path
+    )
 
 
-@app.route("/assets/<path:path>")
 def send_asset(path):
     return send_from_directory(os.path.join(scriptdir, "assets"), path)
 
 
-@app.route("/img/<path:path>")
 def send_img(path):
-    return send_from_directory(os.path.join(curdir, "img"), path)
+    return send_from_directory(
+        os.path.join(current_app.config["root"], "img"), path
+    )
 
 
-@app.route("/eq/<eq_id>/")
 def show_eq(eq_id):
-    if app.config.get("MATHJAX_WHOLEBOOK"):
+    book = current_app.prepare_book()
+    if current_app.config.get("MATHJAX_WHOLEBOOK"):
         # look by number in mathjax'ed wholebook
 
-        if wholebook is None:
-            abort(404)
-
-        soup = BeautifulSoup(wholebook, "html.parser")
-        anchor = soup.find(id="mjx-eqn-" + str(eq_id))
-        if not anchor:
+        tag = current_app.render_wholebook(book).eq_index.get(str(eq_id))
+        if tag is None:
             print("[mjx-eqn-" + str(eq_id) + " not found]")
             return "[mjx-eqn-" + str(eq_id) + " not found]"
-        tag = anchor.find_parent(class_="mjx-chtml")
-        return str(tag)
+        return tag
     else:
         # look by label
-        tree, formatter = prepare_book()
-        tag = formatter.label_to_tag.get(eq_id)
+        tag = book.formatter.label_to_tag.get(eq_id)
 
         if not tag:
             abort(404)
@@ -125,18 +165,17 @@ def show_eq(eq_id):
         if tag.name == "item":
             tag = tag.parent
 
-        return formatter.handle(tag)
+        with book.formatter.rendering() as formatter:
+            return formatter.handle(tag)
 
 
-# @app.route("/wholebook/")
 def show_allthebook():
-    if wholebook is None:
-        abort(404)
+    book = current_app.render_wholebook(current_app.prepare_book())
 
     return render_template(
         "preview.html",
-        html=wholebook,
-        template_options=app.config.get("template_options"),
+        html=book.wholebook,
+        template_options=current_app.config.get("template_options"),
     )
 
 
@@ -173,92 +212,505 @@ def strip_tag_by_name(tree: QqTag, name: str) -> QqTag:
             newtree.append_child(strip_tag_by_name(child, name))
     return newtree
 
-def prepare_book():
-    global wholebook
-    if app.config.get("freeze"):
-        global tree
-        global formatter
-        if wholebook is not None:
-            return tree, formatter
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return path, None, None
+    return path, stat.st_mtime_ns, stat.st_size
 
-    path = os.path.join(curdir, app.config["FILE"])
-    if not os.path.isfile(path):
-        abort(404)
-    with open(path) as f:
-        lines = f.readlines()
-    parser = QqParser()
-    formatter = QqFlaskHTMLFormatter(
-        eq_preview_by_labels=not app.config.get("MATHJAX_WHOLEBOOK")
-    )
 
-    parser.allowed_tags.update(formatter.uses_tags())
-    parser.allowed_tags.update(["idx", "source"])  # idx for indexes
+class QqTrackingParser(QqParser):
+    """
+    QqParser that remembers stamps of the files it reads
+    (the main file and included ones)
+    """
 
-    tree = parser.parse(lines).process_include_tags(parser, curdir)
-    print(tree)
-    tree = strip_tag_by_name(tree, "source")
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stamps = []
 
+    def parse_file(self, filename):
+        self.stamps.append(file_stamp(filename))
+        return super().parse_file(filename)
 
-    formatter.root = tree
-    formatter.pythonfigure_globals.update({"ob": odebook, "np": numpy})
-    formatter.code_prefixes["pythonfigure"] += (
-        "import numpy as np\n"
-        "import qqmbr.odebook as ob\n"
-        "# see https://github.com/ischurov/qqmbr/blob/master/qqmbr/odebook.py"
-        "\n\n"
-    )
 
-    formatter.code_prefixes["pythonvideo"] = formatter.code_prefixes[
-        "pythonfigure"
-    ]
+def book_changed(stamps: List[tuple]) -> bool:
+    return any(file_stamp(stamp[0]) != stamp for stamp in stamps)
 
-    formatter.plotly_globals.update({"np": numpy})
-    formatter.code_prefixes["plotly"] = (
-        formatter.code_prefixes.get("plotly", "")
-        + "import numpy as np\n\n"
-    )
 
-    formatter.mode = "bychapters"
-    formatter.make_numbers(tree)
-    formatter.make_chapters()
+def with_children(tag: QqTag, *children) -> QqTag:
+    """
+    Returns copy of tag with children appended, tag itself is not
+    changed (it can be shared between requests).
 
-    # dirty hack to get equation snippet work
+    The copy is an adopter of tag's children, so they still see tag as
+    their parent, and takes tag's place in the tree: new children see
+    the same ancestors as tag's own children.
 
-    if wholebook is None:
-        if app.config.get("MATHJAX_WHOLEBOOK"):
-            style, wholebook = mathjax(
-                get_preamble(tree) + formatter.format(tree)
-            )
+    :param tag:
+    :param children:
+    :return:
+    """
+    copy = QqTag(
+        tag.name, list(tag), parent=tag.parent, idx=tag.idx, adopt=True
+    )
+    for child in children:
+        copy.append_child(child)
+        if isinstance(child, QqTag):
+            child.parent = copy
+            child.idx = len(copy) - 1
+    return copy
+
+
+class ChapterPrewarmer(object):
+    """
+    Background thread that renders chapters nobody asked for yet,
+    so navigation doesn't wait on rendering. After every served
+    chapter, the next and the previous chapters are rendered first,
+    then chapters it refers to, then others, the closest first.
+
+    Rendered chapters are kept in the book, so they are forgotten
+    when the book is changed. The thread doesn't render chapters
+    of a book that is changed or replaced.
+    """
+
+    def __init__(self, app: "BookApp") -> None:
+        self.app = app
+        self.condition = threading.Condition()
+        # (book, index of the last served chapter, indexes of chapters
+        # it refers to)
+        self.focus: Optional[Tuple[Book, int, Set[int]]] = None
+        # chapters of the focus book that failed to render
+        self.failed: Set[int] = set()
+        self.thread: Optional[threading.Thread] = None
+
+    def chapter_served(
+        self, book: Book, index: int, referenced: Set[int]
+    ) -> None:
+        with self.condition:
+            if self.focus is None or self.focus[0] is not book:
+                self.failed = set()
+            self.focus = book, index, referenced
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="qqmathbook-prewarm", daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    @staticmethod
+    def priority(index: int, current: int, referenced: Set[int]) -> tuple:
+        if index == current + 1:
+            group = 0
+        elif index == current - 1:
+            group = 1
+        elif index in referenced:
+            group = 2
         else:
-            wholebook = formatter.format(tree)
-            style = ""
-        app.config["css_correction"] = style + app.config.get(
-            "css_correction"
+            group = 3
+        return group, abs(index - current), index
+
+    def next_chapter(self) -> Optional[Tuple[Book, int]]:
+        if self.focus is None:
+            return None
+        book, current, referenced = self.focus
+        if book is not self.app.book or book_changed(book.stamps):
+            # the next request loads the new book
+            return None
+        missing = [
+            index
+            for index in range(len(book.formatter.chapters))
+            if index not in book.chapters and index not in self.failed
+        ]
+        if not missing:
+            return None
+        return book, min(
+            missing,
+            key=lambda index: self.priority(index, current, referenced),
         )
 
-    return tree, formatter
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                task = self.next_chapter()
+                while task is None:
+                    self.condition.wait()
+                    task = self.next_chapter()
+            book, index = task
+            try:
+                self.app.render_chapter(book, index)
+            except Exception:
+                self.app.logger.exception(
+                    "Can't prerender chapter {}".format(index)
+                )
+                with self.condition:
+                    if self.focus is not None and self.focus[0] is book:
+                        self.failed.add(index)
+
+
+class BookApp(Flask):
+    """
+    Flask app that serves one book, see create_app
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.book: Optional[Book] = None
+        self.book_lock = threading.RLock()
+        self.mathjax_pool: Optional[MathJaxPool] = None
+        self.mathjax_pool_pid: Optional[int] = None
+        self.formula_cache: Optional[FormulaCache] = None
+        # (python_sandbox, figure_sandbox, figure_session) and pid
+        # of the process they belong to
+        self.sandboxes = None
+        self.sandboxes_pid: Optional[int] = None
+        # list to record url_for calls of the thread to,
+        # see recording_url_for
+        self.url_for_calls = threading.local()
+        self.url_defaults(self.record_url_for)
+        self.prewarmer = ChapterPrewarmer(self)
+
+    def prepare_book(self) -> Book:
+        """
+        Returns the book, loads it if it is not loaded yet or (in
+        preview mode) its files are changed
+
+        :return:
+        """
+        book = self.book
+        if book is not None and (
+            self.config.get("freeze") or not book_changed(book.stamps)
+        ):
+            return book
+        with self.book_lock:
+            book = self.book
+            if book is None or (
+                not self.config.get("freeze") and book_changed(book.stamps)
+            ):
+                book = self.load_book()
+            return book
+
+    def load_book(self) -> Book:
+        root = self.config["root"]
+        path = os.path.join(root, self.config["FILE"])
+        if not os.path.isfile(path):
+            abort(404)
+        parser = QqTrackingParser()
+        formatter = QqFlaskHTMLFormatter(
+            self.config,
+            eq_preview_by_labels=not self.config.get("MATHJAX_WHOLEBOOK"),
+        )
+
+        parser.allowed_tags.update(formatter.uses_tags())
+        parser.allowed_tags.update(["idx", "source"])  # idx for indexes
+
+        tree = parser.parse_file(path).process_include_tags(parser, root)
+        tree = strip_tag_by_name(tree, "source")
+
+        formatter.root = tree
+        formatter.pythonfigure_globals.update({"ob": odebook, "np": numpy})
+        formatter.code_prefixes["pythonfigure"] += (
+            "import numpy as np\n"
+            "import qqmbr.odebook as ob\n"
+            "# see https://github.com/ischurov/qqmbr/blob/master/qqmbr/"
+            "odebook.py\n\n"
+        )
+
+        formatter.code_prefixes["pythonvideo"] = formatter.code_prefixes[
+            "pythonfigure"
+        ]
+
+        formatter.plotly_globals.update({"np": numpy})
+        formatter.code_prefixes["plotly"] = (
+            formatter.code_prefixes.get("plotly", "")
+            + "import numpy as np\n\n"
+        )
+
+        if self.config.get("sandbox"):
+            self.attach_sandboxes(formatter)
+
+        formatter.mode = "bychapters"
+        formatter.make_numbers(tree)
+        formatter.make_chapters()
+
+        book = Book(tree, formatter, parser.stamps)
+        if self.config.get("freeze"):
+            # build needs everything anyway
+            formatter.prerender_figures(jobs=self.config.get("jobs"))
+            self.render_wholebook(book)
+
+        self.book = book
+        return book
+
+    def render_wholebook(self, book: Book) -> Book:
+        """
+        Renders the whole book and, with MATHJAX_WHOLEBOOK, typesets
+        it and builds index of equations. Done once, on first use.
+
+        :param book:
+        :return: book
+        """
+        if book.wholebook is not None:
+            return book
+        with book.wholebook_lock:
+            if book.wholebook is not None:
+                return book
+            if self.config.get("freeze"):
+                jobs = self.config.get("jobs")
+            else:
+                # forking a threaded server is not safe
+                jobs = 1
+
+            # dirty hack to get equation snippet work
+
+            chapters = self.render_chapters(book, jobs=jobs)
+            wholebook = "".join(chapter.html for chapter in chapters)
+            if self.config.get("MATHJAX_WHOLEBOOK"):
+                book.wholebook_style, wholebook = self.mathjax(
+                    wholebook, get_preamble(book.tree)
+                )
+                book.eq_index = build_eq_index(wholebook)
+            book.formatter.figure_manifest.save()
+            book.wholebook = wholebook
+        return book
+
+    def warm_up(self, book: Book) -> None:
+        """
+        Starts background thread (once per book) that prepares the
+        rest of the book after the first page is served: renders
+        missing figures and, with MATHJAX_WHOLEBOOK, the whole book
+        that is needed for equation snippets.
+
+        :param book:
+        """
+        with book.warming_lock:
+            if book.warming is not None:
+                return
+            book.warming = threading.Thread(
+                target=self._warm_up,
+                args=(book,),
+                name="qqmathbook-warm-up",
+                daemon=True,
+            )
+        book.warming.start()
+
+    def _warm_up(self, book: Book) -> None:
+        try:
+            if self.book is book:
+                book.formatter.prerender_figures(
+                    jobs=self.config.get("jobs")
+                )
+            if self.book is book and self.config.get("MATHJAX_WHOLEBOOK"):
+                self.render_wholebook(book)
+        except Exception:
+            # the page that needs it will report the error
+            self.logger.exception("Can't prepare the book")
+
+    def render_chapter(self, book: Book, index: int) -> RenderedChapter:
+        """
+        Renders chapter, or takes it from book.chapters if it is
+        rendered already
+
+        :param book:
+        :param index:
+        :return:
+        """
+        rendered = book.chapters.get(index)
+        if rendered is not None:
+            return rendered
+        with contextlib.ExitStack() as stack:
+            # concurrent requests of the chapter wait for one rendering
+            stack.enter_context(book.chapter_lock(index))
+            rendered = book.chapters.get(index)
+            if rendered is not None:
+                return rendered
+            if not has_request_context():
+                stack.enter_context(
+                    self.test_request_context(
+                        base_url=self.config.get("FREEZER_BASE_URL")
+                    )
+                )
+            calls = stack.enter_context(self.recording_url_for())
+            # the clone has python state of its own
+            formatter = stack.enter_context(book.formatter.rendering())
+            # pythoncode blocks see globals of the preceding chapters
+            formatter.replay_preceding_chapters(index)
+            content = formatter.chapters[index].content
+            formatter.prerender_figures(
+                jobs=self.config.get("jobs"),
+                tag=QqTag("_chapter", content, adopt=True),
+            )
+            # the page loads only css and js its own content needs
+            assets = stack.enter_context(
+                formatter.collect_assets(propagate=False)
+            )
+            html = formatter.format(content, blanks_to_pars=True)
+        formatter.figure_manifest.save()
+        rendered = RenderedChapter(html, assets, calls)
+        if not self.config.get("FREEZER_RELATIVE_URLS"):
+            # otherwise urls depend on the page that is being rendered
+            book.chapters[index] = rendered
+        return rendered
+
+    def render_chapters(
+        self, book: Book, jobs: Optional[int] = None
+    ) -> List[RenderedChapter]:
+        """
+        Renders all chapters of the book, in a pool of forked processes
+        if jobs is not 1. Book is prepared (and numbered) once in the
+        current process, so workers get it for free.
+
+        :param book:
+        :param jobs: number of processes, None for number of CPUs
+        :return: rendered chapters in order
+        """
+        global prerendering
+        indexes = [
+            index
+            for index in range(len(book.formatter.chapters))
+            if index not in book.chapters
+        ]
+        if (
+            jobs != 1
+            and len(indexes) > 1
+            and "fork" in multiprocessing.get_all_start_methods()
+            and not self.config.get("FREEZER_RELATIVE_URLS")
+        ):
+            prerendering = self, book
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=multiprocessing.get_context("fork"),
+                ) as executor:
+                    for index, (rendered, changes) in zip(
+                        indexes, executor.map(_render_chapter, indexes)
+                    ):
+                        book.chapters[index] = rendered
+                        book.formatter.figure_manifest.merge(changes)
+            finally:
+                prerendering = None
+        return [
+            self.render_chapter(book, index)
+            for index in range(len(book.formatter.chapters))
+        ]
+
+    def record_url_for(self, endpoint, values):
+        calls = getattr(self.url_for_calls, "calls", None)
+        if calls is not None:
+            calls.append((endpoint, dict(values)))
+
+    @contextlib.contextmanager
+    def recording_url_for(self):
+        """
+        Records url_for calls made by the current thread in the block
+        to the yielded list
+        """
+        outer = getattr(self.url_for_calls, "calls", None)
+        self.url_for_calls.calls = calls = []
+        try:
+            yield calls
+        finally:
+            self.url_for_calls.calls = outer
+            if outer is not None:
+                outer.extend(calls)
+
+    def prerender_chapters(self):
+        """
+        Prepares the book for build (all chapters are rendered
+        in parallel, see render_chapters)
+        """
+        with self.test_request_context(
+            base_url=self.config.get("FREEZER_BASE_URL")
+        ):
+            self.prepare_book()
+
+    def mathjax_if_needed(self, s, preamble=""):
+        if not self.config.get("mathjax_node"):
+            return "", preamble + s
+        return self.mathjax(s, preamble)
+
+    def get_mathjax_pool(self) -> MathJaxPool:
+        if self.mathjax_pool is None or self.mathjax_pool_pid != os.getpid():
+            # workers of a parent process can't be shared
+            # with a forked one
+            self.formula_cache = None
+            self.mathjax_pool_pid = os.getpid()
+            self.mathjax_pool = MathJaxPool(
+                [
+                    self.config["node"],
+                    self.config["mjworker"],
+                    self.config["mathjax_node_page"],
+                    (
+                        "https://cdnjs.cloudflare.com/ajax/libs/"
+                        "mathjax/2.7.0/fonts/HTML-CSS"
+                    ),
+                ],
+                size=self.config.get("mathjax_workers"),
+            )
+            atexit.register(self.mathjax_pool.close)
+        return self.mathjax_pool
+
+    def attach_sandboxes(self, formatter: QqHTMLFormatter) -> None:
+        """
+        Makes formatter run pythoncode blocks and figures in sandboxed
+        worker processes. Workers are shared by all formatters
+        of the process.
+
+        :param formatter:
+        """
+        if self.sandboxes is None or self.sandboxes_pid != os.getpid():
+            self.sandboxes_pid = os.getpid()
+            self.sandboxes = formatter.make_sandboxes(
+                size=self.config.get("jobs"),
+                timeout=self.config.get("sandbox_timeout"),
+                memory_limit=self.config.get("sandbox_memory"),
+                max_tasks=self.config.get("sandbox_max_tasks"),
+            )
+            for sandbox in self.sandboxes:
+                atexit.register(sandbox.close)
+        (
+            formatter.python_sandbox,
+            formatter.figure_sandbox,
+            formatter.figure_session,
+        ) = self.sandboxes
+        formatter.python_sandbox_held = False
+        formatter.reset_python_globals()
+
+    def get_formula_cache(self) -> FormulaCache:
+        pool = self.get_mathjax_pool()
+        if self.formula_cache is None:
+            self.formula_cache = FormulaCache(
+                self.config["mathjax_cache"], pool
+            )
+        return self.formula_cache
+
+    def mathjax(self, s, preamble=""):
+        if self.config.get("mathjax_cache"):
+            return self.get_formula_cache().typeset(s, preamble)
+
+        return typeset_page(self.get_mathjax_pool(), preamble + s)
 
 
 def show_chapter(index=None, label=None):
     print("Processing chapter index = {}, label = {}".format(index, label))
 
-    tree, formatter = prepare_book()
+    app = current_app
+    book = app.prepare_book()
 
     if index is None and label is None:
-        index = min(1, len(formatter.chapters) - 1)
+        index = min(1, len(book.formatter.chapters) - 1)
 
     if index is None:
-        index = formatter.label_to_chapter[label]
-    # for x in formatter.chapters[index].content:
-    #    if isinstance(x, QqTag):
-    #        print(x.as_list())
-    #    else:
-    #        print(x)
+        index = book.formatter.label_to_chapter[label]
 
-    html = formatter.format(
-        formatter.chapters[index].content, blanks_to_pars=True
-    )
+    rendered = app.render_chapter(book, index)
+    if app.config.get("freeze"):
+        # let Frozen-Flask know about urls used in the chapter
+        for endpoint, values in rendered.url_for_calls:
+            url_for(endpoint, **values)
 
+    formatter = book.formatter
     if index == len(formatter.chapters) - 1:
         next = None
     else:
@@ -269,29 +721,46 @@ def show_chapter(index=None, label=None):
     else:
         prev = formatter.url_for_chapter(index=index - 1)
 
-    style, body = mathjax_if_needed(html, get_preamble(tree))
+    style, body = app.mathjax_if_needed(
+        rendered.html, get_preamble(book.tree)
+    )
 
+    # only css and js the chapter needs, in build as in preview
+    assets = rendered.assets
     style += "\n".join(
-        itertools.chain(formatter.css.values(), formatter.js_top.values())
+        itertools.chain(assets["css"].values(), assets["js_top"].values())
     )
 
-    html = style + app.config.get("css_correction", "") + body
-
-    ftoc = formatter.format_toc(
-        formatter.extract_toc(maxlevel=1), fromchapter=index
+    html = (
+        style
+        + book.wholebook_style
+        + app.config.get("css_correction", "")
+        + body
     )
 
-    curftoc = formatter.format_toc(
-        formatter.extract_toc(maxlevel=3).children[index],
-        fromchapter=index,
-        tochapter=index,
-    )
+    with formatter.rendering() as formatter:
+        ftoc = formatter.format_toc(
+            book.chapters_toc, fromchapter=index, strings=book.toc_strings
+        )
+
+        curftoc = formatter.format_toc(
+            book.toc.children[index],
+            fromchapter=index,
+            tochapter=index,
+            strings=book.toc_strings,
+        )
 
     chapter_heading = formatter.chapters[index].heading
     # print(formatter.chapters[index].content)
+    if not app.config.get("freeze"):
+        app.warm_up(book)
+        if app.config.get("prewarm"):
+            app.prewarmer.chapter_served(
+                book, index, referenced_chapters(book, rendered)
+            )
     return render_template(
         "preview.html",
-        meta=tree.find("meta"),
+        meta=book.tree.find("meta"),
         html=html,
         title=(chapter_heading.text_content),
         ftoc=ftoc,
@@ -299,26 +768,42 @@ def show_chapter(index=None, label=None):
         preamble="",
         next=next,
         prev=prev,
-        js_bottom="\n".join(formatter.js_bottom.values()),
-        js_onload="\n".join(formatter.js_onload.values()),
+        js_bottom="\n".join(assets["js_bottom"].values()),
+        js_onload="\n".join(assets["js_onload"].values()),
         template_options=app.config.get("template_options"),
     )
 
 
-@app.route("/chapter/index/<int:index>/")
+def referenced_chapters(book: Book, rendered: RenderedChapter) -> Set[int]:
+    """
+    Indexes of chapters that rendered chapter has links to
+
+    :param book:
+    :param rendered:
+    :return:
+    """
+    indexes = set()
+    for endpoint, values in rendered.url_for_calls:
+        if endpoint == "show_chapter_by_index":
+            indexes.add(values["index"])
+        elif endpoint == "show_chapter_by_label":
+            index = book.formatter.label_to_chapter.get(values["label"])
+            if index is not None:
+                indexes.add(index)
+    return indexes
+
+
 def show_chapter_by_index(index=None):
     return show_chapter(index=index)
 
 
-@app.route("/chapter/label/<label>/")
 def show_chapter_by_label(label):
     return show_chapter(label=label)
 
 
-@app.route("/snippet/<label>/")
 def show_snippet(label):
-    tree, formatter = prepare_book()
-    tag = formatter.label_to_tag.get(label)
+    book = current_app.prepare_book()
+    tag = book.formatter.label_to_tag.get(label)
     if tag is None or tag.name != "snippet":
         abort(404)
     if tag.exists("backref"):
@@ -328,116 +813,149 @@ def show_snippet(label):
     else:
         backref = label
 
-    parser = QqParser()
-    parser.allowed_tags.update(formatter.uses_tags())
-    if backref:
-        backref_tag = parser.parse(
-            r"\ref[{}\nonumber][{}]".format(
-                formatter.localize("More details"), backref
+    with book.formatter.rendering() as formatter:
+        if backref:
+            parser = QqParser()
+            parser.allowed_tags.update(formatter.uses_tags())
+            backref_tag = parser.parse(
+                r"\ref[{}\nonumber][{}]".format(
+                    formatter.localize("More details"), backref
+                )
+            )
+            tag = with_children(tag, " ", backref_tag.ref_)
+
+        with formatter.collect_assets(propagate=False) as assets:
+            html = formatter.format(tag, blanks_to_pars=True)
+
+    html = current_app.mathjax_if_needed(
+        html, preamble=get_preamble(book.tree)
+    )[1]
+    # snippet is inserted into the page it is shown on, its scripts
+    # are executed on insertion; onload code of the page is not rerun
+    return (
+        "\n".join(
+            itertools.chain(
+                assets["css"].values(), assets["js_top"].values()
             )
         )
-        tag.append_child(" ")
-        tag.append_child(backref_tag.ref_)
-
-    html = formatter.format(tag, blanks_to_pars=True)
-
-    del tag[len(tag) - 1]
-
-    return mathjax_if_needed(html, preamble=get_preamble(tree))[1]
+        + html
+    )
 
 
-@app.route("/")
 def show_default():
     return show_chapter_by_index()
 
 
-def mathjax_if_needed(s, preamble=""):
-    if not app.config.get("mathjax_node"):
-        return "", preamble + s
-    return mathjax(preamble + s)
-
-
-def fix_mjpage_bug(inp, out):
-    replacements = {}
-    bad_pattern = re.compile(
-        "[а-яА-Яa-zA-Z ]{0,10}\uFFFD\uFFFD[а-яА-Яa-zA-Z ]{0,10}"
+# (app, book) whose chapters are rendered by forked workers,
+# see BookApp.render_chapters
+prerendering: Optional[Tuple[BookApp, Book]] = None
+
+
+def _render_chapter(
+    index: int,
+) -> Tuple[RenderedChapter, Dict[str, Optional[dict]]]:
+    app, book = prerendering
+    if app.config.get("sandbox"):
+        # workers of the parent process can't be used in a forked one
+        app.attach_sandboxes(book.formatter)
+    # the parent merges figures rendered by the workers and saves
+    # the manifest once
+    manifest = book.formatter.figure_manifest
+    manifest.autosave = False
+    rendered = app.render_chapter(book, index)
+    return rendered, manifest.take_changes()
+
+
+def create_app(
+    filename: str = "index.qq", root: Optional[str] = None, **config
+) -> BookApp:
+    """
+    Creates app that serves the book. Every app has its own book
+    state, and requests don't change it, so the app can be served
+    by several threads or processes, e.g. with gunicorn:
+
+        gunicorn --threads 8 "qqmbr.qqmathbook:create_app('index.qq')"
+
+    :param filename: main file of the book, relative to root
+    :param root: directory of the book (figures, images and caches are
+                 kept there), current directory if None
+    :param config: values of app.config to override
+    :return:
+    """
+    if root is None:
+        root = os.getcwd()
+    app = BookApp(__name__, static_url_path="")
+
+    app.config["root"] = root
+    app.config["FILE"] = filename
+    app.config["mathjax_node_page"] = os.path.join(
+        scriptdir, "../third-party/node_modules/mathjax-node-page"
     )
-    for m in re.finditer(bad_pattern, out):
-        # print(f"Bad input found: {m.group(0)}")
-        pattern = m.group(0).replace("\uFFFD\uFFFD", ".")
-        replacement = re.search(pattern, inp)
-        if replacement:
-            # (f"Replacement found: {replacement}")
-            replacements[m.group(0)] = replacement.group(0)
-        else:
-            pass
-            # print(f"{pattern} not found.")
-    return re.sub(
-        bad_pattern,
-        lambda m: replacements.get(m.group(0), m.group(0)),
-        out,
+    app.config["mjworker"] = os.path.join(scriptdir, "mjworker.js")
+    app.config["node"] = "node"
+    app.config["mathjax_workers"] = None
+    # typeset formulas are cached here, set to None to disable
+    app.config["mathjax_cache"] = os.path.join(root, ".qqcache", "mathjax")
+    # rendered blocks are cached here, set to None to disable
+    app.config["cache_dir"] = os.path.join(root, ".qqcache")
+
+    app.config["mathjax_node"] = False
+    app.config[
+        "css_correction"
+    ] = r"""
+<style type='text/css'>
+.mjx-chtml {
+font-size: 120%;
+}
+</style>
+<!-- 
+<script type="text/javascript" src="http://livejs.com/live.js"></script>
+-->
+"""
+    app.config["MATHJAX_WHOLEBOOK"] = False
+    app.config.update(config)
+
+    app.debug = True
+
+    app.add_url_rule("/fig/<path:path>", view_func=send_fig)
+    app.add_url_rule("/assets/<path:path>", view_func=send_asset)
+    app.add_url_rule("/img/<path:path>", view_func=send_img)
+    app.add_url_rule("/eq/<eq_id>/", view_func=show_eq)
+    # app.add_url_rule("/wholebook/", view_func=show_allthebook)
+    app.add_url_rule(
+        "/chapter/index/<int:index>/", view_func=show_chapter_by_index
     )
-
-
-def mathjax(s):
-    with open("temp.log", "w") as f:
-        f.write(s)
-
-    p = Popen(
-        [
-            app.config["mjpage"],
-            "--dollars",
-            "--output",
-            "CommonHTML",
-            "--fontURL",
-            (
-                "https://cdnjs.cloudflare.com/ajax/libs/"
-                "mathjax/2.7.0/fonts/HTML-CSS"
-            ),
-        ],
-        stdout=PIPE,
-        stdin=PIPE,
-        stderr=PIPE,
+    app.add_url_rule(
+        "/chapter/label/<label>/", view_func=show_chapter_by_label
     )
-
-    # filename = hashlib.sha256(s.encode('utf-8')).hexdigest()
-    # with open(filename, 'w') as f:
-    #    print(s, file=f)
-
-    res = p.communicate(input=s.encode("utf-8"))
-    out = res[0].decode("utf-8")
-    err = res[1].decode("utf-8")
-
-    out = fix_mjpage_bug(s, out)
-
-    soup = BeautifulSoup(out, "html.parser")
-    style = str(soup.style)
-    body = "".join(str(s) for s in soup.body.children)
-
-    return style, body
+    app.add_url_rule("/snippet/<label>/", view_func=show_snippet)
+    app.add_url_rule("/", view_func=show_default)
+    return app
 
 
 commands = {}
 
 
 def register_command(f):
-    commands[f.__name__] = f
+    commands[f.__name__.replace("_", "-")] = f
     return f
 
 
 @register_command
-def preview(**args):
-    app.run(host="0.0.0.0", port=5001)
+def preview(app, **args):
+    app.run(host="0.0.0.0", port=5001, threaded=True)
 
 
 @register_command
-def build(**args):
+def build(app, **args):
     freezer = Freezer(app)
     if args.get("base_url"):
         app.config["FREEZER_BASE_URL"] = args.get("base_url")
     app.config["mathjax_node"] = args.get("node_mathjax", False)
     app.config["MATHJAX_WHOLEBOOK"] = args.get("node_mathjax", False)
-    app.config["FREEZER_DESTINATION"] = os.path.join(curdir, "build")
+    app.config["FREEZER_DESTINATION"] = os.path.join(
+        app.config["root"], "build"
+    )
     app.config["freeze"] = True
 
     if args.get("template_options"):
@@ -445,13 +963,14 @@ def build(**args):
             args["template_options"]
         )
 
+    app.prerender_chapters()
     freezer.freeze()
 
     if args.get("copy_mathjax"):
 
         mathjax_postfix = os.path.join("assets", "js", "mathjax")
         mathjax_from = os.path.join(scriptdir, mathjax_postfix)
-        mathjax_to = os.path.join(curdir, "build", mathjax_postfix)
+        mathjax_to = os.path.join(app.config["root"], "build", mathjax_postfix)
 
         try:
             shutil.rmtree(mathjax_to)
@@ -461,9 +980,76 @@ def build(**args):
         shutil.copytree(mathjax_from, mathjax_to)
 
 
+size_units = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+
+
+def parse_size(s: str) -> int:
+    """
+    Parses size like 500M or 2G (in bytes if no unit is given)
+
+    :param s:
+    :return: size in bytes
+    """
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", s, re.I)
+    if not m:
+        raise argparse.ArgumentTypeError("Invalid size: " + s)
+    return int(float(m.group(1)) * size_units[m.group(2).upper()])
+
+
 @register_command
-def convert(**args):
-    path = os.path.join(curdir, app.config["FILE"])
+def gc_figures(app, **args):
+    """
+    Removes rendered figures that are not used by the book anymore,
+    then least recently used ones until figures take at most --max-size.
+    Prunes other caches the same way, by --max-cache-age and
+    --max-cache-size.
+    """
+    with app.test_request_context():
+        book = app.prepare_book()
+        formatter = book.formatter
+        referenced = {
+            formatter.python_fig_path(code, video=video)
+            for code, exts, video in formatter.python_figures(book.tree)
+        }
+    removed, freed = formatter.figure_manifest.gc(
+        referenced,
+        max_size=args.get("max_size"),
+        figname=formatter.default_figname,
+    )
+    print(
+        "Removed {} figures, freed {:.1f} MB".format(
+            removed, freed / 2 ** 20
+        )
+    )
+
+    cache_dirs = []
+    if formatter.cache_dir is not None:
+        cache_dirs.extend(
+            os.path.join(formatter.cache_dir, name)
+            for name in formatter.cache_subdirs
+        )
+    if app.config.get("mathjax_cache"):
+        cache_dirs.append(app.config["mathjax_cache"])
+    max_age = args.get("max_cache_age")
+    removed, freed = 0, 0
+    for cache_dir in cache_dirs:
+        dir_removed, dir_freed = prune_cache(
+            cache_dir,
+            max_age=None if max_age is None else max_age * 24 * 3600,
+            max_size=args.get("max_cache_size"),
+        )
+        removed += dir_removed
+        freed += dir_freed
+    print(
+        "Removed {} cached files, freed {:.1f} MB".format(
+            removed, freed / 2 ** 20
+        )
+    )
+
+
+@register_command
+def convert(app, **args):
+    path = os.path.join(app.config["root"], app.config["FILE"])
     with open(path) as f:
         lines = f.readlines()
 
@@ -488,7 +1074,8 @@ def convert(**args):
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
-        "command", help="command to invoke: preview or build"
+        "command",
+        help="command to invoke: preview, build or gc-figures",
     )
     argparser.add_argument(
         "file", help="File to proceed", default="index.qq", nargs="?"
@@ -508,13 +1095,146 @@ def main():
     argparser.add_argument(
         "--template_options", help="Additional options for template (JSON)"
     )
+    argparser.add_argument(
+        "--jobs",
+        help=(
+            "Number of processes to render python figures and, "
+            "for build, chapters "
+            "(default: number of CPUs, 1 to disable parallel rendering)"
+        ),
+        type=int,
+    )
+    argparser.add_argument(
+        "--mathjax-workers",
+        help=(
+            "Maximal number of server-side MathJax processes "
+            "(default: number of CPUs)"
+        ),
+        type=int,
+    )
+    argparser.add_argument(
+        "--no-cache",
+        help="Don't cache rendered blocks",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--no-mathjax-cache",
+        help="Don't cache formulas typeset by server-side MathJax",
+        action="store_true",
+    )
+
+    argparser.add_argument(
+        "--animation-jobs",
+        help=(
+            "Render frames of \\pythonvideo animations in this number "
+            "of processes and cache them "
+            "(default: render every video in one go)"
+        ),
+        type=int,
+    )
+    argparser.add_argument(
+        "--external-frames",
+        help=(
+            "Save frames of \\jsanimate videos to separate files "
+            "instead of embedding them into pages"
+        ),
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--sandbox",
+        help=(
+            "Run \\pythoncode blocks and python figures "
+            "in separate worker processes"
+        ),
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--sandbox-timeout",
+        help="Time limit for one block or figure in sandbox, seconds",
+        type=float,
+    )
+    argparser.add_argument(
+        "--sandbox-memory",
+        help="Memory limit of a sandbox worker, e.g. 2G",
+        type=parse_size,
+    )
+    argparser.add_argument(
+        "--sandbox-max-tasks",
+        help="Restart sandbox worker after this number of tasks "
+        "(default: 100)",
+        type=int,
+        default=100,
+    )
+    argparser.add_argument(
+        "--prewarm",
+        help=(
+            "For preview: render other chapters in background "
+            "after the first page is served"
+        ),
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--highlight",
+        help=(
+            "Highlight code with pygments when rendering "
+            "instead of highlight.js in the browser"
+        ),
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--highlight-style",
+        help="Pygments style for --highlight (default: default)",
+    )
+    argparser.add_argument(
+        "--max-size",
+        help=(
+            "For gc-figures: maximal total size of rendered figures, "
+            "e.g. 500M or 2G (default: no limit)"
+        ),
+        type=parse_size,
+    )
+    argparser.add_argument(
+        "--max-cache-age",
+        help=(
+            "For gc-figures: remove cached output (fragments, frames, "
+            "plotly, pythoncode, formulas etc.) not used for this "
+            "number of days (default: 30)"
+        ),
+        type=float,
+        default=30,
+    )
+    argparser.add_argument(
+        "--max-cache-size",
+        help=(
+            "For gc-figures: maximal total size of every cache, "
+            "e.g. 500M or 2G (default: no limit)"
+        ),
+        type=parse_size,
+    )
 
     args = argparser.parse_args()
 
-    app.config["FILE"] = args.file
+    config = dict(
+        jobs=args.jobs,
+        mathjax_workers=args.mathjax_workers,
+        jsanimate_external_frames=args.external_frames,
+        animation_jobs=args.animation_jobs,
+        sandbox=args.sandbox,
+        sandbox_timeout=args.sandbox_timeout,
+        sandbox_memory=args.sandbox_memory,
+        sandbox_max_tasks=args.sandbox_max_tasks,
+        prewarm=args.prewarm,
+        highlight_code=args.highlight,
+        highlight_style=args.highlight_style,
+    )
+    if args.no_cache:
+        config["cache_dir"] = None
+    if args.no_mathjax_cache:
+        config["mathjax_cache"] = None
+    app = create_app(args.file, **config)
 
     if args.command in commands:
-        commands[args.command](**vars(args))
+        commands[args.command](app, **vars(args))
     else:
         print("Unknown command " + args.command)
 
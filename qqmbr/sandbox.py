@@ -0,0 +1,298 @@
+# (c) Ilya V. Schurov, 2016
+# Available under MIT license (see LICENSE file in the root folder)
+
+"""
+Worker processes for user code (pythoncode blocks and python figures).
+
+Every call is executed in a separate process with wall-clock time limit
+and memory limit (RLIMIT_AS), so infinite loop or huge array in the
+book doesn't stall or kill the server. Worker is killed on timeout and
+a new one is started when needed. Workers are recycled after max_tasks
+calls to cap memory growth.
+"""
+
+from typing import Any, Callable, List, Optional, Tuple
+import multiprocessing
+import queue
+import threading
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class SandboxError(Exception):
+    pass
+
+
+class SandboxTimeout(SandboxError):
+    pass
+
+
+class SandboxCrash(SandboxError):
+    pass
+
+
+def _worker_main(
+    conn,
+    memory_limit: Optional[int],
+    initializer: Optional[Callable],
+    initargs: tuple,
+) -> None:
+    if memory_limit is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        func, args = task
+        try:
+            reply = (True, func(*args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # result or exception can't be pickled
+            conn.send((False, SandboxError(repr(e))))
+
+
+class SandboxWorker(object):
+    # processes are started from scratch: forking a threaded server
+    # is not safe
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(
+        self,
+        memory_limit: Optional[int] = None,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+    ) -> None:
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def call(
+        self, func: Callable, args: tuple, timeout: Optional[float] = None
+    ) -> Any:
+        """
+        Calls func(*args) in the worker process
+
+        :param func: picklable (module-level) function
+        :param args: picklable arguments
+        :param timeout: seconds, None for no limit
+        :raises SandboxTimeout: the call took more than timeout,
+                                worker is killed
+        :raises SandboxCrash: worker died
+        :return: result of func
+        """
+        self.tasks += 1
+        try:
+            self.conn.send((func, args))
+            if not self.conn.poll(timeout):
+                self.kill()
+                raise SandboxTimeout(
+                    "Execution took more than {} seconds".format(timeout)
+                )
+            ok, result = self.conn.recv()
+        except (EOFError, OSError):
+            self.kill()
+            raise SandboxCrash(
+                "Worker process died with exit code {}".format(
+                    self.process.exitcode
+                )
+            )
+        if not ok:
+            raise result
+        return result
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+        self.conn.close()
+
+
+class SandboxPool(object):
+    """
+    Pool of workers for independent calls. Workers are started lazily,
+    up to size, when there are more concurrent calls than idle workers.
+
+    Can be used from several threads.
+    """
+
+    def __init__(
+        self,
+        size: int = 1,
+        timeout: Optional[float] = None,
+        memory_limit: Optional[int] = None,
+        max_tasks: Optional[int] = None,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+    ) -> None:
+        self.size = size
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        self.initializer = initializer
+        self.initargs = initargs
+        self._workers: List[SandboxWorker] = []
+        self._idle: "queue.LifoQueue[SandboxWorker]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _start(self) -> SandboxWorker:
+        return SandboxWorker(
+            self.memory_limit, self.initializer, self.initargs
+        )
+
+    def _acquire(self) -> SandboxWorker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._workers) < self.size:
+                worker = self._start()
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def _release(self, worker: SandboxWorker) -> None:
+        if not worker.alive() or (
+            self.max_tasks is not None and worker.tasks >= self.max_tasks
+        ):
+            worker.close()
+            worker = self._start()
+            with self._lock:
+                self._workers = [
+                    w for w in self._workers if w.alive()
+                ] + [worker]
+        self._idle.put(worker)
+
+    def call(self, func: Callable, *args) -> Any:
+        """
+        Calls func(*args) on one of the workers, see SandboxWorker.call
+        """
+        worker = self._acquire()
+        try:
+            return worker.call(func, args, self.timeout)
+        finally:
+            self._release(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+class SandboxSession(object):
+    """
+    One worker that keeps state between calls (e.g. globals of
+    pythoncode blocks).
+
+    Successful calls since the last reset are recorded and replayed
+    when the worker is restarted after timeout or crash, so the state
+    is restored lazily, on the next call. Worker is recycled after
+    max_tasks calls only on reset, when the state is empty anyway.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        memory_limit: Optional[int] = None,
+        max_tasks: Optional[int] = None,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = (),
+    ) -> None:
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        self.initializer = initializer
+        self.initargs = initargs
+        self.worker: Optional[SandboxWorker] = None
+        self.history: List[Tuple[Callable, tuple]] = []
+        self.lock = threading.RLock()
+
+    def _worker(self) -> SandboxWorker:
+        if self.worker is None or not self.worker.alive():
+            self.worker = SandboxWorker(
+                self.memory_limit, self.initializer, self.initargs
+            )
+            for func, args in self.history:
+                try:
+                    self.worker.call(func, args, self.timeout)
+                except SandboxError:
+                    # worker is killed, don't replay
+                    # the rest of the history
+                    break
+                except Exception:
+                    pass
+        return self.worker
+
+    def call(self, func: Callable, *args) -> Any:
+        """
+        Calls func(*args) in the worker, see SandboxWorker.call
+        """
+        with self.lock:
+            try:
+                result = self._worker().call(func, args, self.timeout)
+            except SandboxError:
+                raise
+            except Exception:
+                self.history.append((func, args))
+                raise
+            self.history.append((func, args))
+            return result
+
+    def reset(self, func: Optional[Callable] = None, *args) -> None:
+        """
+        Forgets the history and calls func(*args) that should clear
+        the state in the worker
+
+        :param func:
+        """
+        with self.lock:
+            self.history.clear()
+            worker = self.worker
+            if worker is None or not worker.alive():
+                return
+            if self.max_tasks is not None and worker.tasks >= self.max_tasks:
+                worker.close()
+                self.worker = None
+            elif func is not None:
+                try:
+                    worker.call(func, args, self.timeout)
+                except SandboxError:
+                    self.worker = None
+
+    def close(self) -> None:
+        with self.lock:
+            if self.worker is not None:
+                self.worker.close()
+                self.worker = None
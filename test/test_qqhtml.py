@@ -2,13 +2,38 @@
 # Available under MIT license (see LICENSE file in the root folder)
 
 from indentml.parser import QqParser
-from qqmbr.qqhtml import QqHTMLFormatter
+from qqmbr.qqhtml import (
+    QqHTMLFormatter,
+    FlabelIndex,
+    save_atomically,
+    plotly_div_id_re,
+)
+from qqmbr.figmanifest import FigureManifest, prune_cache
+from qqmbr.sandbox import SandboxTimeout
+from qqmbr.qqmathbook import create_app, build, ChapterPrewarmer
+import qqmbr.animframes as animframes
+from qqmbr.mjnode import (
+    FormulaCache,
+    MathJaxError,
+    MathJaxPool,
+    build_eq_index,
+)
+import qqmbr.mjnode as mjnode
 
 import unittest
+import matplotlib
 from bs4 import BeautifulSoup
+from fuzzywuzzy import process
 import os
+import re
+import sys
+import shutil
+import random
+import time
 import contextlib
+import tempfile
 from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor
 
 
 # FROM: http://code.activestate.com/recipes/576620-changedirectory-context-manager/
@@ -29,6 +54,31 @@ def working_directory(path):
 # END FROM
 
 
+class FakeMathJaxPool(object):
+    """
+    Typesets $...$ as <span class="mjx">...</span>, style of every
+    batch has its number
+    """
+
+    def __init__(self):
+        self.pages = []
+
+    def typeset(self, pages):
+        out = []
+        for page in pages:
+            self.pages.append(page)
+            out.append(
+                "<html><head><style>/* {} */</style></head><body>".format(
+                    len(self.pages)
+                )
+                + re.sub(
+                    r"(?<!\\)\$(.+?)\$", r'<span class="mjx">\1</span>', page
+                )
+                + "</body></html>"
+            )
+        return out
+
+
 class TestQqHtmlMethods(unittest.TestCase):
     def test_parse_html1(self):
         parser = QqParser(allowed_tags={'chapter', 'section', 'subsection',
@@ -147,6 +197,49 @@ Hello
         self.assertEqual(html.tag2chapter(tree.equation_.label_), 1)
         self.assertEqual(html.tag2chapter(tree.remark_), 2)
         self.assertEqual(html.tag2chapter(tree.remark_.ref_), 2)
+        html.make_numbers(tree)
+        self.assertEqual(html.label2chapter("eq1"), 1)
+        self.assertEqual(html.label2chapter("rem"), 2)
+
+    def test_handler_registry(self):
+        class Formatter(QqHTMLFormatter):
+            def handle_strong(self, tag):
+                return "<b>" + self.format(tag, blanks_to_pars=False) + "</b>"
+
+            def handle_kbd(self, tag):
+                """
+                Uses tags: key
+                """
+                return "<kbd>{}</kbd>".format(
+                    self.format(tag, blanks_to_pars=False)
+                )
+
+        # build the parent's registry first: subclass must not inherit it
+        self.assertNotIn("kbd", QqHTMLFormatter.handler_registry()[0])
+        handlers, tags = Formatter.handler_registry()
+        self.assertIs(handlers["strong"], Formatter.handle_strong)
+        self.assertIs(handlers["em"], QqHTMLFormatter.handle_em)
+        self.assertIn("kbd", handlers)
+        self.assertIn("key", tags)
+        self.assertIs(Formatter.handler_registry()[0], handlers)
+
+        parent_handlers, parent_tags = QqHTMLFormatter.handler_registry()
+        self.assertIs(parent_handlers["strong"], QqHTMLFormatter.handle_strong)
+        self.assertNotIn("kbd", parent_handlers)
+        self.assertNotIn("key", parent_tags)
+
+        doc = "Press \\kbd{Ctrl} and \\strong{hold}\n"
+        tree = QqParser(allowed_tags=Formatter().uses_tags()).parse(doc)
+        s = Formatter(tree).do_format()
+        self.assertIn("<kbd>Ctrl</kbd>", s)
+        self.assertIn("<b>hold</b>", s)
+
+        tree = QqParser(
+            allowed_tags=QqHTMLFormatter().uses_tags() | {"kbd"}
+        ).parse(doc)
+        s = QqHTMLFormatter(tree).do_format()
+        self.assertNotIn("<kbd>", s)
+        self.assertIn("<strong>hold</strong>", s)
 
     def test_ref_with_separator(self):
         doc = r"""\chapter Hello \label sec:first
@@ -243,3 +336,963 @@ See
         soup = BeautifulSoup(html, "html.parser")
         self.assertEqual(soup("a")[2].contents[0], "section [sec:third]")
         self.assertEqual(soup("a")[3].contents[0], "zection [sec:another]")
+
+    def test_find_tag_by_flabel(self):
+        doc = r"""\definition \label def:ivp \flabel initial value problem
+    Initial value problem is a problem with initial value.
+
+\definition \label def:cauchy \flabel Cauchy problem
+    Same as initial value problem.
+
+\definition \label def:bvp \flabel boundary value problem
+    Problem with boundary conditions.
+
+See \snref[Initial value problem], \snref[cauchy's problem]
+and \snref[boundary problems].
+"""
+        parser = QqParser()
+        formatter = QqHTMLFormatter()
+        parser.allowed_tags.update(formatter.uses_tags())
+        tree = parser.parse(doc)
+        formatter.root = tree
+        formatter.make_numbers(tree)
+        for query in ["initial value problem", "Cauchy's problem",
+                      "boundary problems", "value", "qwerty", ""]:
+            self.assertEqual(
+                formatter.find_tag_by_flabel(query),
+                formatter.flabel_to_tag[
+                    process.extractOne(query.lower(),
+                                       formatter.flabel_to_tag.keys())[0]
+                ]
+            )
+        html = formatter.format(tree)
+        soup = BeautifulSoup(html, "html.parser")
+        self.assertEqual(
+            [a["data-url"] for a in soup("a", class_="snippet-ref")],
+            ["/snippet/def:ivp", "/snippet/def:cauchy", "/snippet/def:bvp"]
+        )
+
+    def test_flabel_index(self):
+        flabels = [
+            "field point", "initial", "initial value problem",
+            "cauchy problem", "boundary value problem", "phase space",
+            "phase portrait", "equilibrium point", "stable point",
+            "lyapunov function", "linear system", "linear equation",
+            "fundamental matrix", "matrix exponent", "vector field",
+            "direction field", "integral curve", "first integral",
+            "existence and uniqueness", "picard iterations",
+        ]
+        index = FlabelIndex(flabels)
+        rnd = random.Random(0)
+        queries = ["in", "init", "point", "field", "matrix", "problem"]
+        for flabel in flabels:
+            for start in range(0, len(flabel), 3):
+                queries.append(flabel[start : start + rnd.randint(2, 12)])
+        for _ in range(300):
+            queries.append(
+                "".join(
+                    rnd.choice("abcdefilmnoprstuv ")
+                    for _ in range(rnd.randint(2, 15))
+                )
+            )
+        for query in queries:
+            if not query.strip():
+                continue
+            self.assertEqual(
+                index.find(query),
+                process.extractOne(query, flabels)[0],
+                query,
+            )
+
+    def test_fragment_cache(self):
+        def render(doc, cache_dir):
+            formatter = QqHTMLFormatter()
+            formatter.cache_dir = cache_dir
+            parser = QqParser(allowed_tags=formatter.uses_tags())
+            tree = parser.parse(doc)
+            formatter.root = tree
+            formatter.make_numbers(tree)
+            return formatter.format(tree)
+
+        doc = r"""\theorem \label thm:a
+    Hello
+
+\remark
+    See \ref{thm:a}.
+"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            html = render(doc, cache_dir)
+            self.assertEqual(html, render(doc, None))
+            self.assertEqual(html, render(doc, cache_dir))
+
+            # remark is not changed, but the number of theorem is
+            doc = "\\theorem\n    Inserted\n\n" + doc
+            soup = BeautifulSoup(render(doc, cache_dir), "html.parser")
+            self.assertEqual(soup.find("a", class_="a-ref").text, "2")
+
+    def test_python_fig_path(self):
+        code = "plt.plot([1, 2])"
+        formatter = QqHTMLFormatter()
+        path = formatter.python_fig_path(code)
+        self.assertEqual(path, QqHTMLFormatter().python_fig_path(code))
+        self.assertNotEqual(path, formatter.python_fig_path(code, video=True))
+
+        formatter = QqHTMLFormatter()
+        formatter.figure_rcparams["figure.figsize"] = (8, 6)
+        self.assertNotEqual(path, formatter.python_fig_path(code))
+
+        formatter = QqHTMLFormatter()
+        formatter.pythonfigure_globals["k"] = 2
+        self.assertNotEqual(path, formatter.python_fig_path(code))
+
+        # rcParams in effect, e.g. set by a style
+        with matplotlib.rc_context({"lines.linewidth": 5}):
+            self.assertNotEqual(
+                path, QqHTMLFormatter().python_fig_path(code)
+            )
+
+        # environment assigned after the first use
+        formatter = QqHTMLFormatter()
+        self.assertEqual(path, formatter.python_fig_path(code))
+        formatter.pythonfigure_globals = dict(
+            formatter.pythonfigure_globals, k=2
+        )
+        self.assertNotEqual(path, formatter.python_fig_path(code))
+        formatter.pythonfigure_globals = QqHTMLFormatter().pythonfigure_globals
+        self.assertEqual(path, formatter.python_fig_path(code))
+        with matplotlib.rc_context():
+            formatter.figure_rcparams = {"figure.dpi": 50}
+            self.assertNotEqual(path, formatter.python_fig_path(code))
+
+    def test_animation_frames_cache(self):
+        code = dedent("""\
+            fig = plt.figure()
+            camera = Camera(fig)
+            for i in range(4):
+                plt.plot([0, i], [0, {} if i == 3 else i], color="b")
+                plt.xlim(0, 10)
+                plt.ylim(0, 10)
+                camera.snap()
+            animation = camera.animate()
+            """)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            formatter = QqHTMLFormatter()
+            formatter.figures_dir = os.path.join(tmpdir, "fig")
+            formatter.cache_dir = os.path.join(tmpdir, "cache")
+            formatter.animation_jobs = 1
+            frames_dir = os.path.join(tmpdir, "cache", "frames")
+
+            def count_frames():
+                return sum(len(files) for _, _, files in os.walk(frames_dir))
+
+            path = formatter.make_python_fig(
+                code.format(3), exts=("jshtml",), video=True
+            )
+            self.assertEqual(count_frames(), 4)
+            with open(os.path.join(formatter.figures_dir, path,
+                                   "fig.jshtml")) as f:
+                self.assertEqual(f.read().count("data:image/"), 4)
+
+            # only the last frame is changed
+            formatter.make_python_fig(
+                code.format(5), exts=("jshtml",), video=True
+            )
+            self.assertEqual(count_frames(), 5)
+
+    def test_animation_frames_fallback(self):
+        code = dedent("""\
+            fig = plt.figure()
+            camera = Camera(fig)
+            for i in range(3):
+                plt.plot([0, i], [0, i])
+                camera.snap()
+            animation = camera.animate()
+            """)
+        supported = animframes.supported_matplotlib
+        animframes.supported_matplotlib = ((0, 0), (0, 0))
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                formatter = QqHTMLFormatter()
+                formatter.figures_dir = os.path.join(tmpdir, "fig")
+                formatter.cache_dir = os.path.join(tmpdir, "cache")
+                formatter.animation_jobs = 1
+                path = formatter.make_python_fig(
+                    code, exts=("jshtml",), video=True
+                )
+                # rendered with Animation.to_jshtml
+                self.assertFalse(
+                    os.path.exists(os.path.join(tmpdir, "cache", "frames"))
+                )
+                with open(os.path.join(formatter.figures_dir, path,
+                                       "fig.jshtml")) as f:
+                    self.assertEqual(f.read().count("data:image/"), 3)
+        finally:
+            animframes.supported_matplotlib = supported
+
+    @unittest.skipIf(
+        shutil.which(matplotlib.rcParams["animation.ffmpeg_path"]) is None,
+        "ffmpeg is not available",
+    )
+    def test_animation_frames_mp4(self):
+        code = dedent("""\
+            fig = plt.figure(figsize=(3.05, 2.05))
+            camera = Camera(fig)
+            for i in range(3):
+                plt.plot([0, i], [0, i])
+                camera.snap()
+            animation = camera.animate()
+            """)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            formatter = QqHTMLFormatter()
+            formatter.figures_dir = os.path.join(tmpdir, "fig")
+            formatter.cache_dir = os.path.join(tmpdir, "cache")
+            formatter.animation_jobs = 1
+            path = formatter.make_python_fig(code, exts=("mp4",), video=True)
+            with open(os.path.join(formatter.figures_dir, path,
+                                   "fig.mp4"), "rb") as f:
+                self.assertEqual(f.read(8)[4:], b"ftyp")
+
+    def test_plotly_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            runs = os.path.join(tmpdir, "runs")
+            code = dedent("""\
+                open({!r}, "a").write("x")
+                plot([go.Scatter(x=[1, 2], y=[k, 3 * k])])
+                """).format(runs)
+
+            def render():
+                formatter = QqHTMLFormatter()
+                formatter.cache_dir = os.path.join(tmpdir, "cache")
+                formatter.plotly_globals["k"] = k
+                return formatter.make_plotly_fig(code)
+
+            def div_ids(output):
+                return set(plotly_div_id_re.findall(output))
+
+            def count_runs():
+                with open(runs) as f:
+                    return len(f.read())
+
+            k = 2
+            first = render()
+            self.assertEqual(count_runs(), 1)
+            self.assertIn("[2,6]", first.replace(" ", ""))
+
+            second = render()
+            self.assertEqual(count_runs(), 1)
+            self.assertTrue(div_ids(first))
+            self.assertFalse(div_ids(first) & div_ids(second))
+            self.assertEqual(
+                plotly_div_id_re.sub("", first),
+                plotly_div_id_re.sub("", second),
+            )
+
+            # globals are part of the key
+            k = 3
+            self.assertIn("[3,9]", render().replace(" ", ""))
+            self.assertEqual(count_runs(), 2)
+
+    def test_jsanimate_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            runs = os.path.join(tmpdir, "runs")
+            code = dedent("""\
+                open({!r}, "a").write("x")
+                fig = plt.figure()
+                camera = Camera(fig)
+                for i in range(2):
+                    plt.plot([0, i], [0, {}])
+                    camera.snap()
+                animation = camera.animate()
+                """)
+
+            def render(y):
+                formatter = QqHTMLFormatter()
+                formatter.figures_dir = os.path.join(tmpdir, "fig")
+                return formatter.make_python_jsanimate(code.format(runs, y))
+
+            def count_runs():
+                with open(runs) as f:
+                    return len(f.read())
+
+            def anim_ids(html):
+                return set(re.findall(r"_anim_img([0-9a-f]{32})", html))
+
+            first = render(1)
+            self.assertEqual(count_runs(), 1)
+            self.assertIn('class="figure img-responsive"', first)
+
+            second = render(1)
+            self.assertEqual(count_runs(), 1)
+            self.assertEqual(len(anim_ids(second)), 1)
+            self.assertNotEqual(anim_ids(first), anim_ids(second))
+
+            render(2)
+            self.assertEqual(count_runs(), 2)
+
+    def test_pythoncode_cache(self):
+        def render(second, cache_dir):
+            doc = dedent(r"""
+                \pythoncode
+                    x = 21
+                    print("first")
+
+                \pythoncode
+                    {}
+                """).format(second)
+            formatter = QqHTMLFormatter()
+            formatter.cache_dir = cache_dir
+            tree = QqParser(allowed_tags=formatter.uses_tags()).parse(doc)
+            formatter.root = tree
+            soup = BeautifulSoup(formatter.format(tree), "html.parser")
+            return [code.text.strip() for code in soup("code")]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(render("print(x)", cache_dir), ["first", "21"])
+            self.assertEqual(render("print(x)", cache_dir), ["first", "21"])
+            # the first block is taken from cache, but executed before
+            # the second one
+            self.assertEqual(
+                render("print(x * 2)", cache_dir), ["first", "42"]
+            )
+
+    def test_pythoncode_sandbox(self):
+        doc = dedent(r"""
+            \pythoncode
+                x = 5
+
+            \pythoncode
+                while True:
+                    pass
+
+            \pythoncode
+                print(x)
+            """)
+        formatter = QqHTMLFormatter()
+        sandboxes = formatter.make_sandboxes(size=1, timeout=2)
+        (
+            formatter.python_sandbox,
+            formatter.figure_sandbox,
+            formatter.figure_session,
+        ) = sandboxes
+        try:
+            tree = QqParser(allowed_tags=formatter.uses_tags()).parse(doc)
+            formatter.root = tree
+            soup = BeautifulSoup(formatter.format(tree), "html.parser")
+        finally:
+            for sandbox in sandboxes:
+                sandbox.close()
+        outputs = [code.text.strip() for code in soup("code")]
+        self.assertTrue(outputs[1].startswith("Exception: SandboxTimeout"))
+        # worker is restarted with x restored
+        self.assertEqual(outputs[2], "5")
+
+    dependent_figures = dedent(r"""
+        \pythonfigure
+            def helper():
+                return [0, 1, 4]
+            plt.plot(helper())
+
+        \pythonfigure
+            plt.plot(helper(), helper())
+        """)
+
+    def render_dependent_figures(self, formatter, figures_dir):
+        formatter.figures_dir = figures_dir
+        tree = QqParser(allowed_tags=formatter.uses_tags()).parse(
+            self.dependent_figures
+        )
+        formatter.root = tree
+        # the second figure can't be rendered without the first one
+        with self.assertLogs("qqmbr.qqhtml", "WARNING") as logs:
+            formatter.prerender_figures(jobs=2)
+        self.assertIn("NameError", logs.output[0])
+        formatter.format(tree)
+        return sorted(
+            os.path.relpath(os.path.join(path, name), figures_dir)
+            for path, _, files in os.walk(figures_dir)
+            for name in files
+            if name == "fig.svg"
+        )
+
+    def test_prerender_dependent_figures(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            figures = self.render_dependent_figures(
+                QqHTMLFormatter(), os.path.join(tmpdir, "fig")
+            )
+        self.assertEqual(len(figures), 2)
+
+    def test_figure_sandbox_globals(self):
+        formatter = QqHTMLFormatter()
+        sandboxes = formatter.make_sandboxes(size=2, timeout=30)
+        (
+            formatter.python_sandbox,
+            formatter.figure_sandbox,
+            formatter.figure_session,
+        ) = sandboxes
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                figures = self.render_dependent_figures(
+                    formatter, os.path.join(tmpdir, "fig")
+                )
+        finally:
+            for sandbox in sandboxes:
+                sandbox.close()
+        self.assertEqual(len(figures), 2)
+
+    def test_sandbox_video_and_plotly(self):
+        video = dedent("""\
+            from matplotlib.animation import FuncAnimation
+            fig = plt.figure()
+            def draw(i):
+                while True:
+                    pass
+            animation = FuncAnimation(fig, draw, frames=3)
+            """)
+        formatter = QqHTMLFormatter()
+        formatter.animation_jobs = 1
+        sandboxes = formatter.make_sandboxes(size=1, timeout=3)
+        (
+            formatter.python_sandbox,
+            formatter.figure_sandbox,
+            formatter.figure_session,
+        ) = sandboxes
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                formatter.figures_dir = os.path.join(tmpdir, "fig")
+                # frames are not rendered in this process
+                with self.assertRaises(SandboxTimeout):
+                    formatter.make_python_fig(
+                        video, exts=("jshtml",), video=True
+                    )
+                self.assertEqual(formatter.figure_manifest.figures, {})
+            formatter.plotly_globals["k"] = 2
+            output = formatter.make_plotly_fig(
+                "plot([go.Scatter(x=[1, 2], y=[k, 3 * k])])"
+            )
+        finally:
+            for sandbox in sandboxes:
+                sandbox.close()
+        self.assertIn("plotly-graph-div", output)
+        self.assertIn("[2,6]", output.replace(" ", ""))
+
+    def test_save_atomically(self):
+        def save(tmp):
+            with open(tmp, "w") as f:
+                f.write("partial")
+            raise MemoryError
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "fig.svg")
+            with self.assertRaises(MemoryError):
+                save_atomically(path, save)
+            self.assertEqual(os.listdir(tmpdir), [])
+            save_atomically(path, lambda tmp: shutil.copy(__file__, tmp))
+            self.assertEqual(os.listdir(tmpdir), ["fig.svg"])
+
+    def test_concurrent_rendering(self):
+        doc = dedent(r"""
+            \chapter First
+            \pythoncode
+                x = 1
+                print(x)
+            \quiz
+                \choice
+                    No
+                \choice \correct
+                    Yes
+
+            \chapter Second
+            \pythoncode
+                print(x if "x" in globals() else "no x")
+                x = 2
+                print(x)
+            """)
+        formatter = QqHTMLFormatter()
+        tree = QqParser(allowed_tags=formatter.uses_tags()).parse(doc)
+        formatter.root = tree
+        formatter.mode = "bychapters"
+        formatter.make_numbers(tree)
+        formatter.make_chapters()
+        before = tree.as_list()
+
+        def render(index):
+            with formatter.rendering() as renderer:
+                renderer.replay_preceding_chapters(index)
+                return renderer.format(
+                    renderer.chapters[index].content, blanks_to_pars=True
+                )
+
+        expected = [render(index) for index in (1, 2)]
+        # globals of the preceding chapter are kept
+        self.assertIn("<code class=\"lang-python\">1\n2", expected[1])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(render, [1, 2] * 20))
+        self.assertEqual(results, expected * 20)
+        # rendering doesn't change the shared tree
+        self.assertEqual(tree.as_list(), before)
+
+    def test_book_reuse(self):
+        with tempfile.TemporaryDirectory() as root:
+            def write(name, text):
+                with open(os.path.join(root, name), "w") as f:
+                    f.write(dedent(text))
+
+            write("index.qq", r"""
+                \chapter First
+                Hello
+                \_include second.qq
+                """)
+            write("second.qq", r"""
+                \chapter Second
+                World
+                """)
+            app = create_app(root=root)
+            with app.test_request_context():
+                book = app.prepare_book()
+                self.assertIs(app.prepare_book(), book)
+
+                # included file is changed
+                write("second.qq", r"""
+                    \chapter Second
+                    Changed world
+                    """)
+                changed = app.prepare_book()
+                self.assertIsNot(changed, book)
+                self.assertIn("Changed world", repr(changed.tree.as_list()))
+                self.assertIs(app.prepare_book(), changed)
+
+                # build doesn't look at the files
+                app.config["freeze"] = True
+                write("index.qq", "Gone\n")
+                self.assertIs(app.prepare_book(), changed)
+
+    chapters_book = dedent(r"""
+        \chapter First \label ch:first
+        One, see \ref{ch:fourth}.
+
+        \chapter Second
+        Two
+
+        \chapter Third
+        Three
+
+        \chapter Fourth \label ch:fourth
+        Four
+        """)
+
+    def make_book_app(self, root, **config):
+        with open(os.path.join(root, "index.qq"), "w") as f:
+            f.write(self.chapters_book)
+        return create_app(
+            root=root, cache_dir=None, mathjax_cache=None, **config
+        )
+
+    def test_wholebook_from_chapters(self):
+        with tempfile.TemporaryDirectory() as root:
+            app = self.make_book_app(root, jobs=1)
+            with app.test_request_context():
+                book = app.prepare_book()
+                chapter = app.render_chapter(book, 2)
+                app.render_wholebook(book)
+                # rendered chapter is reused, not rendered again
+                self.assertIs(book.chapters[2], chapter)
+                self.assertEqual(len(book.chapters), 5)
+                self.assertEqual(
+                    book.wholebook,
+                    "".join(book.chapters[i].html for i in range(5)),
+                )
+            soup = BeautifulSoup(book.wholebook, "html.parser")
+            self.assertEqual(
+                [h1.text.strip() for h1 in soup("h1")],
+                ["1First", "2Second", "3Third", "4Fourth"],
+            )
+
+            response = app.test_client().get("/chapter/index/2/")
+            self.assertIn(chapter.html, response.get_data(as_text=True))
+            self.assertIs(app.book, book)
+            self.assertIs(book.chapters[2], chapter)
+
+    def test_lazy_wholebook(self):
+        with tempfile.TemporaryDirectory() as root:
+            app = self.make_book_app(root)
+            with app.test_request_context():
+                book = app.prepare_book()
+            self.assertIsNone(book.wholebook)
+            self.assertEqual(book.chapters, {})
+
+            client = app.test_client()
+            response = client.get("/chapter/index/3/")
+            self.assertIn("Three", response.get_data(as_text=True))
+            self.assertIsNone(book.wholebook)
+            self.assertEqual(list(book.chapters), [3])
+            # warm-up is started once per book
+            warming = book.warming
+            self.assertIsNotNone(warming)
+            client.get("/chapter/index/1/")
+            self.assertIs(book.warming, warming)
+            warming.join(30)
+            self.assertIsNone(book.wholebook)
+
+            with app.test_request_context():
+                self.assertIs(app.render_wholebook(book), book)
+            self.assertIn("Four", book.wholebook)
+
+            # build renders everything at once
+            app = self.make_book_app(root, freeze=True, jobs=1)
+            with app.test_request_context():
+                book = app.prepare_book()
+            self.assertIsNotNone(book.wholebook)
+            self.assertEqual(len(book.chapters), 5)
+
+    def test_prewarm(self):
+        priority = ChapterPrewarmer.priority
+        self.assertEqual(
+            sorted([0, 1, 3, 4, 5], key=lambda i: priority(i, 2, {5})),
+            [3, 1, 5, 0, 4],
+        )
+
+        with tempfile.TemporaryDirectory() as root:
+            app = self.make_book_app(root, prewarm=True)
+            book = app.prepare_book()
+            self.assertEqual(book.chapters, {})
+            app.test_client().get("/chapter/index/1/")
+            prewarmer = app.prewarmer
+            self.assertIs(prewarmer.focus[0], book)
+            # chapter 1 refers to chapter 4
+            self.assertEqual(prewarmer.focus[1:], (1, {4}))
+
+            deadline = time.monotonic() + 30
+            while len(book.chapters) < 5 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(sorted(book.chapters), [0, 1, 2, 3, 4])
+            with app.test_request_context():
+                self.assertIn("Four", app.render_chapter(book, 4).html)
+
+            # chapters of a changed book are not rendered
+            with open(os.path.join(root, "index.qq"), "a") as f:
+                f.write("\\chapter Fifth\nFive\n")
+            del book.chapters[3]
+            with prewarmer.condition:
+                self.assertIsNone(prewarmer.next_chapter())
+
+    def test_parallel_build(self):
+        book = dedent(r"""
+            \meta
+                \title Small book
+            \chapter First \label chap:first
+            See \ref{chap:second} and \eqref{eq:one}.
+            \equation \label eq:one
+                x^2
+            \pythoncode
+                y = 11
+            \pythonfigure \imgformat png
+                plt.plot([0, 1, 4])
+
+            \chapter Second \label chap:second
+            \pythoncode
+                print(y)
+            \pythonfigure \imgformat png
+                plt.plot([4, 1, 0])
+
+            \chapter Third \label chap:third
+            Back to \ref{chap:first}.
+            """)
+        builds = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for jobs in (1, 2):
+                root = os.path.join(tmpdir, str(jobs))
+                os.makedirs(root)
+                with open(os.path.join(root, "index.qq"), "w") as f:
+                    f.write(book)
+                # MathJax is not installed with the package
+                app = create_app(
+                    root=root, jobs=jobs, FREEZER_IGNORE_404_NOT_FOUND=True
+                )
+                build(app)
+                files = {}
+                for path, _, names in os.walk(os.path.join(root, "build")):
+                    for name in names:
+                        with open(os.path.join(path, name), "rb") as f:
+                            files[
+                                os.path.relpath(os.path.join(path, name), root)
+                            ] = f.read()
+                builds.append(files)
+        self.assertEqual(builds[0], builds[1])
+        self.assertEqual(
+            len([name for name in builds[0] if name.endswith(".png")]), 2
+        )
+        self.assertIn(
+            b'<code class="lang-python">11',
+            builds[0]["build/chapter/label/chap:second/index.html"],
+        )
+
+    def test_scoped_assets(self):
+        doc = dedent(r"""
+            \chapter First
+            \preformatted \lang python
+                print(1)
+
+            \chapter Second
+            Just text
+            """)
+        formatter = QqHTMLFormatter()
+        tree = QqParser(allowed_tags=formatter.uses_tags()).parse(doc)
+        formatter.root = tree
+        formatter.mode = "bychapters"
+        formatter.make_numbers(tree)
+        formatter.make_chapters()
+
+        scoped = []
+        for chapter in formatter.chapters[1:]:
+            with formatter.collect_assets(propagate=False) as assets:
+                formatter.format(chapter.content, blanks_to_pars=True)
+            scoped.append(assets)
+        self.assertIn("highlightjs", scoped[0]["js_top"])
+        self.assertEqual(scoped[1]["js_top"], {})
+        self.assertEqual(formatter.js_top, {})
+
+        with formatter.collect_assets() as assets:
+            formatter.format(
+                formatter.chapters[1].content, blanks_to_pars=True
+            )
+        self.assertEqual(formatter.js_top, assets["js_top"])
+
+    def test_highlight_code(self):
+        doc = dedent(r"""
+            \preformatted \lang python
+                x = 1 < 2
+            """)
+        formatter = QqHTMLFormatter()
+        formatter.highlight_code = True
+        tree = QqParser(allowed_tags=formatter.uses_tags()).parse(doc)
+        formatter.root = tree
+        html = formatter.format(tree, blanks_to_pars=False)
+        self.assertIn('<code class="highlight">', html)
+        self.assertIn('<span class="n">x</span>', html)
+        self.assertIn("&lt;", html)
+        self.assertIn("pygments", formatter.css)
+        self.assertNotIn("highlightjs", formatter.css)
+        self.assertEqual(formatter.js_top, {})
+        # toggle of the code block is still there
+        self.assertIn("showcode", formatter.js_onload)
+        self.assertEqual(len(formatter.highlight_cache), 1)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            formatter = QqHTMLFormatter()
+            formatter.highlight_code = True
+            formatter.cache_dir = cache_dir
+            formatter.root = tree
+            self.assertEqual(
+                formatter.format(tree, blanks_to_pars=False), html
+            )
+            self.assertEqual(
+                len(os.listdir(os.path.join(cache_dir, "highlight"))), 1
+            )
+
+    def test_formula_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            pool = FakeMathJaxPool()
+            cache = FormulaCache(cache_dir, pool)
+            style, body = cache.typeset(r"<p>Costs \$5, $x$</p>")
+            self.assertEqual(
+                body, '<p>Costs $5, <span class="mjx">x</span></p>'
+            )
+            self.assertEqual(len(pool.pages), 1)
+
+            # style is kept per preamble
+            cache.typeset("<p>$y$</p>", preamble="<p>$z$</p>")
+            self.assertEqual(
+                cache.typeset(r"<p>$x$ \$</p>"),
+                (style, '<p><span class="mjx">x</span> $</p>'),
+            )
+            self.assertEqual(len(pool.pages), 2)
+
+            # removed style is a miss
+            shutil.rmtree(os.path.join(cache_dir, "style"))
+            restyled, body = cache.typeset(r"<p>$x$ \$</p>")
+            self.assertEqual(restyled, "<style>/* 3 */</style>")
+            self.assertEqual(len(pool.pages), 3)
+            self.assertEqual(cache.typeset("<p>$x$</p>")[0], restyled)
+            self.assertEqual(len(pool.pages), 3)
+
+            # macros defined in the body apply to the next formulas
+            page = r"<p>$\newcommand{\R}{x}$ and $\R$</p>"
+            style, body = cache.typeset(page)
+            self.assertEqual(pool.pages[-1], page)
+            self.assertIn('<span class="mjx">\\R</span>', body)
+            # and such pages are not cached
+            cache.typeset(page)
+            self.assertEqual(len(pool.pages), 5)
+
+    def test_build_eq_index(self):
+        equation = (
+            '<span class="mjx-chtml">'
+            '<span id="mjx-eqn-1">(1)</span></span>'
+        )
+        html = (
+            "<p>pasted\u2028text\x0cand\rmore</p>\n"
+            "<div>\n<p>see</p>" + equation + "\n</div>\n"
+        )
+        self.assertEqual(build_eq_index(html), {"1": equation})
+
+    fake_mathjax_worker = dedent("""\
+        import json
+        import sys
+
+        for line in sys.stdin:
+            request = json.loads(line)
+            reply = {
+                "id": request["id"],
+                "pages": ["<b>" + page + "</b>" for page in request["pages"]],
+            }
+            page = request["pages"][0]
+            if page == "error":
+                reply = {"id": request["id"], "error": "bad page"}
+            elif page == "desync":
+                reply["id"] += 1
+            elif page == "exit":
+                sys.exit(1)
+            print(json.dumps(reply), flush=True)
+        """)
+
+    def test_mathjax_pool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            worker = os.path.join(tmpdir, "worker.py")
+            with open(worker, "w") as f:
+                f.write(self.fake_mathjax_worker)
+            pool = MathJaxPool([sys.executable, worker], size=2)
+            try:
+                self.assertEqual(
+                    pool.typeset(["$x$", "y"]), ["<b>$x$</b>", "<b>y</b>"]
+                )
+                for page, message in [
+                    ("error", "bad page"),
+                    ("desync", "out of sync"),
+                    ("exit", "exited with code 1"),
+                ]:
+                    with self.assertRaisesRegex(MathJaxError, message):
+                        pool.typeset([page])
+                    # the worker is discarded, a new one is started
+                    self.assertEqual(pool._workers, [])
+                    self.assertEqual(pool.typeset(["z"]), ["<b>z</b>"])
+
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    results = list(
+                        executor.map(
+                            lambda i: pool.typeset([str(i)])[0], range(20)
+                        )
+                    )
+                self.assertEqual(
+                    results, ["<b>{}</b>".format(i) for i in range(20)]
+                )
+                self.assertLessEqual(len(pool._workers), 2)
+            finally:
+                pool.close()
+
+    @unittest.skipIf(shutil.which("node") is None, "node is not available")
+    def test_mathjax_worker_js(self):
+        mjworker = os.path.join(
+            os.path.dirname(mjnode.__file__), "mjworker.js"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # stands for mathjax-node-page
+            os.makedirs(os.path.join(tmpdir, "mjpage"))
+            with open(os.path.join(tmpdir, "mjpage", "index.js"), "w") as f:
+                f.write(dedent("""\
+                    exports.mjpage = function (page, options, conf, done) {
+                        if (page === "error") {
+                            throw new Error("bad page");
+                        }
+                        console.log("stdout is reserved for replies");
+                        done("<b>" + page + "</b>");
+                    };
+                    """))
+            pool = MathJaxPool(
+                ["node", mjworker, os.path.join(tmpdir, "mjpage"), "fonts"],
+                size=1,
+            )
+            try:
+                self.assertEqual(
+                    pool.typeset(["$x$", "y"]), ["<b>$x$</b>", "<b>y</b>"]
+                )
+                with self.assertRaisesRegex(MathJaxError, "bad page"):
+                    pool.typeset(["error"])
+                self.assertEqual(pool._workers, [])
+                self.assertEqual(pool.typeset(["z"]), ["<b>z</b>"])
+                process = pool._workers[0].process
+            finally:
+                pool.close()
+            # the worker exits when its stdin is closed
+            self.assertEqual(process.returncode, 0)
+
+    def test_figure_manifest_gc(self):
+        with tempfile.TemporaryDirectory() as figures_dir:
+            def make_fig(relpath, size):
+                os.makedirs(os.path.join(figures_dir, relpath))
+                with open(os.path.join(figures_dir, relpath, "fig.svg"),
+                          "w") as f:
+                    f.write("x" * size)
+
+            for relpath in ["aa/aa1", "bb/bb1", "cc/cc1"]:
+                make_fig(relpath, 100)
+            manifest = FigureManifest(figures_dir)
+            for relpath in ["aa/aa1", "bb/bb1", "cc/cc1"]:
+                manifest.add(relpath, ("svg",))
+            manifest.save()
+
+            manifest = FigureManifest(figures_dir)
+            self.assertTrue(manifest.has("bb/bb1", ("svg",)))
+            self.assertFalse(manifest.has("bb/bb1", ("svg", "pdf")))
+
+            removed, freed = manifest.gc({"aa/aa1", "bb/bb1"}, max_size=150)
+            self.assertEqual((removed, freed), (2, 200))
+            self.assertEqual(list(manifest.scan()), ["bb/bb1"])
+            self.assertEqual(
+                list(FigureManifest(figures_dir).figures), ["bb/bb1"]
+            )
+
+            # removed by hand: the manifest is trusted until gc
+            os.remove(os.path.join(figures_dir, "bb/bb1/fig.svg"))
+            self.assertTrue(manifest.has("bb/bb1", ("svg",)))
+            manifest.gc({"bb/bb1"})
+            self.assertFalse(manifest.has("bb/bb1", ("svg",)))
+
+    def test_figure_manifest_merge(self):
+        with tempfile.TemporaryDirectory() as figures_dir:
+            manifest = FigureManifest(figures_dir)
+            manifest.add("aa/aa1", ("svg",))
+            manifest.save()
+            # forked workers get the same state
+            workers = [FigureManifest(figures_dir) for _ in range(2)]
+            for worker, relpath in zip(workers, ["bb/bb1", "cc/cc1"]):
+                worker.autosave = False
+                worker.take_changes()
+                worker.add(relpath, ("svg",))
+                worker.save()
+            self.assertEqual(
+                list(FigureManifest(figures_dir).figures), ["aa/aa1"]
+            )
+            for worker in workers:
+                manifest.merge(worker.take_changes())
+            manifest.save()
+            self.assertEqual(
+                sorted(FigureManifest(figures_dir).figures),
+                ["aa/aa1", "bb/bb1", "cc/cc1"],
+            )
+
+    def test_prune_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            now = time.time()
+            for name, age in [("aa/old", 10), ("bb/mid", 5), ("bb/new", 1)]:
+                path = os.path.join(cache_dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write("x" * 100)
+                os.utime(path, (now - age * 3600, now - age * 3600))
+
+            self.assertEqual(prune_cache(cache_dir, max_age=8 * 3600),
+                             (1, 100))
+            self.assertEqual(os.listdir(cache_dir), ["bb"])
+            self.assertEqual(prune_cache(cache_dir, max_size=150), (1, 100))
+            self.assertEqual(os.listdir(os.path.join(cache_dir, "bb")),
+                             ["new"])